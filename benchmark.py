@@ -0,0 +1,293 @@
+""" Benchmark the solvers on generated puzzles.
+
+    python benchmark.py --houses 5 6 --categories 4 5 --seeds 5 --output results.json
+    python benchmark.py --houses 5 6 --categories 4 5 --seeds 5 --baseline results.json
+
+Every puzzle has a unique solution and each engine checks that by
+counting up to two solutions. Results are written as JSON. With a
+baseline file the results are compared to it and the exit status is 1
+if an engine got slower than the threshold or visited more nodes.
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import exactcover
+import solving
+
+try:
+    import vectorized
+except ImportError:
+    # needs numpy
+    vectorized = None
+
+
+def load_brute_force():
+    """ Return the brute-force Solver module, its directory isn't a package. """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'brute-force', 'Solver.py')
+    spec = importlib.util.spec_from_file_location('brute_force_solver', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate(seed, houses, categories, minimal=True):
+    """ Return attributes and Constraints of a random puzzle with exactly
+    one solution.
+
+    Clues that are true for a random solution are added until the puzzle
+    has a unique solution. If minimal is set, clues that aren't needed
+    for uniqueness are removed afterwards, which makes puzzles harder.
+
+    >>> attributes, constraints = generate(1, 4, 3)
+    >>> attributes[0]
+    ['a0', 'a1', 'a2', 'a3']
+    >>> solving.Solver(attributes, constraints).count_solutions(limit=2)
+    1
+    """
+    generator = random.Random(seed)
+    attributes = [['%s%d' % (chr(ord('a') + category), index) for index in range(houses)]
+                  for category in range(categories)]
+    # group index of every attribute in the solution
+    solution = {}
+    for names in attributes:
+        for name, index in zip(names, generator.sample(range(houses), houses)):
+            solution[name] = index
+    by_index = {}
+    for name, index in solution.items():
+        by_index.setdefault(index, []).append(name)
+    middle = {houses // 2, houses // 2 - 1} if houses % 2 == 0 else {houses // 2}
+    names = sorted(solution)
+
+    def clue():
+        name = generator.choice(names)
+        index = solution[name]
+        kind = generator.choice(['together', 'together', 'together', 'adjacent',
+                                 'adjacent', 'order', 'middle', 'index'])
+        others = None
+        if kind == 'together':
+            others = by_index[index]
+        elif kind == 'adjacent':
+            others = by_index.get(index - 1, []) + by_index.get(index + 1, [])
+        elif kind == 'order':
+            others = by_index.get(index + 1)
+        elif kind == 'middle' and index in middle:
+            return solving.Middle(name)
+        elif kind == 'index':
+            return solving.Together(name, index)
+        others = [other for other in others or [] if other[0] != name[0]]
+        if not others:
+            return None
+        record = {'together': solving.Together, 'adjacent': solving.Adjacent,
+                  'order': solving.Order}[kind]
+        return record(name, generator.choice(others))
+
+    clues = []
+    while True:
+        record = clue()
+        if record is None or record in clues:
+            continue
+        clues.append(record)
+        if len(clues) >= houses and count(attributes, clues) == 1:
+            break
+    if minimal:
+        for record in list(clues):
+            trial = [other for other in clues if other is not record]
+            if count(attributes, trial) == 1:
+                clues = trial
+    constraints = solving.Constraints()
+    for record in clues:
+        constraints.add(record)
+    return attributes, constraints
+
+
+def count(attributes, clues):
+    """ Return number of solutions up to two. """
+    constraints = solving.Constraints()
+    for record in clues:
+        constraints.add(record)
+    return solving.Solver(attributes, constraints).count_solutions(limit=2)
+
+
+def run_solving(attributes, constraints):
+    stats = solving.Stats()
+    solutions = solving.Solver(attributes, constraints, stats=stats).count_solutions(limit=2)
+    return solutions, stats.as_dict()
+
+
+def run_learning(attributes, constraints):
+    stats = solving.Stats()
+    solver = solving.Solver(attributes, constraints, stats=stats, nogoods=solving.Nogoods())
+    return solver.count_solutions(limit=2), stats.as_dict()
+
+
+def run_all_different(attributes, constraints):
+    stats = solving.Stats()
+    solver = solving.Solver(attributes, constraints, stats=stats, all_different=True)
+    return solver.count_solutions(limit=2), stats.as_dict()
+
+
+def run_dlx(attributes, constraints):
+    return exactcover.Solver(attributes, constraints).count_solutions(limit=2), {}
+
+
+def run_brute_force(attributes, constraints, module):
+    brute_constraints = module.Constraints(len(attributes[0]))
+    for record in constraints.clues:
+        getattr(brute_constraints, type(record).__name__.lower())(*record)
+    solver = module.Solver(attributes, brute_constraints)
+    return sum(1 for _ in itertools.islice(solver.solve(), 2)), {}
+
+
+def run_vectorized(attributes, constraints):
+    return vectorized.Solver(attributes, constraints).count_solutions(limit=2), {}
+
+
+def engines(names, brute_force_houses):
+    """ Return dict of engine name to (function, largest puzzle it runs). """
+    available = {}
+    if 'solving' in names:
+        available['solving'] = (run_solving, None)
+    if 'learning' in names:
+        available['learning'] = (run_learning, None)
+    if 'all-different' in names:
+        available['all-different'] = (run_all_different, None)
+    if 'dlx' in names:
+        available['dlx'] = (run_dlx, None)
+    if 'brute-force' in names:
+        module = load_brute_force()
+        available['brute-force'] = (
+            lambda attributes, constraints: run_brute_force(attributes, constraints, module),
+            brute_force_houses)
+    if 'vectorized' in names:
+        if vectorized is None:
+            print('Skipping vectorized engine, numpy is not installed', file=sys.stderr)
+        else:
+            available['vectorized'] = (run_vectorized, brute_force_houses + 2)
+    return available
+
+
+def measure(function, attributes, constraints, repeat):
+    """ Return result of the function, best wall time and peak memory.
+
+    Memory is traced in a separate run so tracing doesn't slow the
+    timed runs.
+    """
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(attributes, constraints)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    tracemalloc.start()
+    try:
+        function(attributes, constraints)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run(houses, categories, seeds, engine_names, repeat=3, minimal=True,
+        brute_force_houses=4):
+    """ Return list of result records for every puzzle and engine. """
+    results = []
+    available = engines(engine_names, brute_force_houses)
+    for house_count, category_count, seed in itertools.product(houses, categories, seeds):
+        attributes, constraints = generate(seed, house_count, category_count, minimal)
+        for name, (function, largest) in available.items():
+            if largest is not None and house_count > largest:
+                continue
+            (solutions, stats), seconds, peak = measure(function, attributes, constraints, repeat)
+            record = {'engine': name, 'houses': house_count, 'categories': category_count,
+                      'seed': seed, 'clues': len(constraints.clues), 'solutions': solutions,
+                      'seconds': seconds, 'peak_bytes': peak}
+            record.update(stats)
+            results.append(record)
+            print('{engine:12} {houses:3} houses {categories:2} categories seed {seed:3}: '
+                  '{seconds:9.4f} s {0} nodes'.format(record.get('nodes', '-'), **record),
+                  file=sys.stderr)
+    return results
+
+
+def key(record):
+    return record['engine'], record['houses'], record['categories'], record['seed']
+
+
+def compare(results, baseline, threshold, floor=0.01):
+    """ Return list of regression messages against the baseline records.
+
+    A run is a regression if it is more than threshold times slower or
+    visits more search nodes than the baseline. Times under floor seconds
+    are mostly noise and aren't compared.
+
+    >>> old = [{'engine': 'solving', 'houses': 5, 'categories': 4, 'seed': 0,
+    ...         'seconds': 1.0, 'nodes': 10}]
+    >>> compare([dict(old[0], seconds=1.1, nodes=12)], old, 1.25)
+    ['solving 5 houses 4 categories seed 0: nodes 10 -> 12']
+    >>> compare([dict(old[0], seconds=2.0)], old, 1.25)
+    ['solving 5 houses 4 categories seed 0: 1.0000 s -> 2.0000 s']
+    """
+    previous = {key(record): record for record in baseline}
+    regressions = []
+    for record in results:
+        old = previous.get(key(record))
+        if old is None:
+            continue
+        name = '{0} {1} houses {2} categories seed {3}'.format(*key(record))
+        if record['seconds'] > max(old['seconds'], floor) * threshold:
+            regressions.append('{0}: {1:.4f} s -> {2:.4f} s'.format(
+                name, old['seconds'], record['seconds']))
+        if old.get('nodes') is not None and record.get('nodes', 0) > old['nodes']:
+            regressions.append('{0}: nodes {1} -> {2}'.format(
+                name, old['nodes'], record['nodes']))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the puzzle solvers.')
+    parser.add_argument('--houses', type=int, nargs='+', default=[5, 6, 7])
+    parser.add_argument('--categories', type=int, nargs='+', default=[4, 5])
+    parser.add_argument('--seeds', type=int, default=5, help='number of puzzles of each size')
+    parser.add_argument('--engines', nargs='+', default=['solving', 'learning', 'dlx',
+                                                     'brute-force', 'vectorized'])
+    parser.add_argument('--brute-force-houses', type=int, default=4,
+                        help='largest puzzle given to the brute-force engine')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs, the best is kept')
+    parser.add_argument('--not-minimal', action='store_true',
+                        help='keep clues that are not needed for a unique solution')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='compare results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown compared to baseline that counts as a regression')
+    parser.add_argument('--floor', type=float, default=0.01,
+                        help='shortest time in seconds that is compared to the baseline')
+    options = parser.parse_args(arguments)
+
+    results = run(options.houses, options.categories, range(options.seeds), options.engines,
+                  options.repeat, not options.not_minimal, options.brute_force_houses)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), options.threshold,
+                                  options.floor)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
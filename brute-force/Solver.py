@@ -1,4 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import doctest
 import itertools
+import math
+import os
 import time
 
 class Solver:
@@ -23,42 +27,251 @@ class Solver:
                 return False
         return True
 
-    def solve(self):
+    def solve(self, start=0, stop=None):
         """ Return generator that produces all groups that pass the 
         constraints. Returned tuples contains correct groups ordered 
         so leftmost group is the first group in the list and rightmost
         is the last and so on. 
+
+        Groups are built one category at a time: every permutation of
+        the category's attributes is appended to the partial groups and
+        constraints are checked as soon as all of their attributes are
+        placed, so failing partial groups are never extended.
+
+        Only groupings numbered from start up to stop are produced, see
+        rank(). Permutations with no such groupings after them are
+        skipped without building them.
+
+        >>> attributes = [['brit', 'norwegian', 'american'], ['red', 'blue', 'green'],
+        ...               ['cat', 'dog', 'goldfish']]
+        >>> constraints = Constraints(3).together('brit', 'red').together('norwegian', 1) \\
+        ...     .adjacent('american', 'cat').together('dog', 'green').order('blue', 'green')
+        >>> list(Solver(attributes, constraints).solve())
+        [(('brit', 'red', 'goldfish'), ('norwegian', 'blue', 'cat'), ('american', 'green', 'dog'))]
+        >>> solver = Solver(attributes, Constraints(3).adjacent('brit', 'cat'))
+        >>> shards = [list(solver.solve(start, start + 17)) for start in range(0, solver.size(), 17)]
+        >>> [groups for shard in shards for groups in shard] == list(solver.solve())
+        True
+        """
+        checks = self.checks()
+        groups = tuple(() for _ in self.attributes[0])
+        size = self.size()
+        stop = size if stop is None else min(stop, size)
+        return self.assign(groups, 0, checks, 0, size, max(start, 0), stop)
+
+    def size(self):
+        """ Return number of groupings: every permutation of every
+        category.
+        """
+        count = 1
+        for attributes in self.attributes:
+            count *= math.factorial(len(attributes))
+        return count
+
+    def rank(self, groups):
+        """ Return the number of the groups among all groupings, in the
+        order solve() produces them.
+
+        The rank of each category's permutation is a digit of a mixed
+        radix number, the first category being the most significant.
+
+        >>> solver = Solver([['a', 'b', 'c'], ['x', 'y', 'z']], Constraints(3))
+        >>> groupings = list(solver.solve())
+        >>> [solver.rank(groups) for groups in groupings] == list(range(solver.size()))
+        True
+        >>> all(solver.unrank(solver.rank(groups)) == groups for groups in groupings)
+        True
+        >>> solver.unrank(7)
+        (('a', 'x'), ('c', 'z'), ('b', 'y'))
         """
-        search_space = all_groupings(self.attributes)
-        # Stop iteration early because 25 billion is too much
-        n = 10000000
-        for _, group_set in zip(range(n), search_space):
-            if(self.check(group_set)):
-                yield group_set
-
-def remove_used(group, attributes):
-    """" Return attributes that are not in the group."""
-    ret = [[subelt for subelt in elt if subelt not in group]
-            for elt in attributes]
-    return ret
-
-
-def all_groupings(attributes):
-    """ Return generator that generates all possible groupings
-    containing an item from each list. Each item is used exactly once
-    in each grouping. Number of groups is the length of sublist.
+        index = 0
+        for category, attributes in enumerate(self.attributes):
+            permutation = [group[category] for group in groups]
+            index = index * math.factorial(len(attributes)) + \
+                rank_permutation(permutation, attributes)
+        return index
+
+    def unrank(self, index):
+        """ Return the groups numbered index, see rank(). """
+        permutations = []
+        for attributes in reversed(self.attributes):
+            index, digit = divmod(index, math.factorial(len(attributes)))
+            permutations.append(unrank_permutation(digit, attributes))
+        return tuple(zip(*reversed(permutations)))
+
+    def checks(self):
+        """ Return list of constraints to check after each category.
+
+        A constraint is checked after the last category containing one
+        of its attributes. Constraints without an 'attributes' list are
+        checked after the last category, constraints naming only group
+        indexes after the first.
+
+        >>> attributes = [['a0', 'a1'], ['b0', 'b1']]
+        >>> constraints = Constraints(2).together(0, 1).together('a0', 'b1')
+        >>> [len(checks) for checks in Solver(attributes, constraints).checks()]
+        [1, 1]
+        >>> list(Solver(attributes, constraints).solve())
+        []
+        >>> len(list(Solver(attributes, Constraints(2).together(1, 1)).solve()))
+        4
+        """
+        categories = {attribute: index
+                      for index, attributes in enumerate(self.attributes)
+                      for attribute in attributes}
+        last = len(self.attributes) - 1
+        checks = [[] for _ in self.attributes]
+        for constraint in self.constraints:
+            attributes = getattr(constraint, 'attributes', None)
+            if attributes is None:
+                index = last
+            else:
+                index = max([categories.get(attribute, last) for attribute in attributes
+                             if not isinstance(attribute, int)] or [0])
+            checks[index].append(constraint)
+        return checks
+
+    def assign(self, groups, category, checks, base, span, start, stop):
+        """ Yield complete groups extending the partial groups with
+        permutations of the category and all the categories after it.
+
+        The span groupings after the partial groups are numbered from
+        base, only those from start up to stop are yielded.
+        """
+        if category == len(self.attributes):
+            yield groups
+            return
+        attributes = self.attributes[category]
+        count = math.factorial(len(attributes))
+        span //= count
+        # ranks of the permutations with groupings from start to stop
+        first = max(start - base, 0) // span
+        last = min(count, (stop - base + span - 1) // span)
+        if first == 0 and last == count:
+            permutations = itertools.permutations(attributes)
+        else:
+            permutations = (unrank_permutation(rank, attributes)
+                            for rank in range(first, last))
+        for rank, permutation in enumerate(permutations, first):
+            candidate = tuple(group + (attribute,)
+                              for group, attribute in zip(groups, permutation))
+            if all(constraint(candidate) for constraint in checks[category]):
+                yield from self.assign(candidate, category + 1, checks,
+                                       base + rank * span, span, start, stop)
+
+
+def rank_permutation(permutation, items):
+    """ Return the position of the permutation among all permutations of
+    the items in the order of itertools.permutations, counted in the
+    factorial number system.
+
+    >>> [rank_permutation(permutation, 'abc') for permutation in itertools.permutations('abc')]
+    [0, 1, 2, 3, 4, 5]
     """
-    if len(attributes[0]) == 1:
-        yield (tuple(x[0] for x in attributes),)
-        return
-    # all permutations from the attributes
-    search_groups = itertools.product(*attributes)
-    for group in search_groups:
-        # complete set of groups containing all attributes
-        group_sets = ((group, *rest) for rest in
-                      all_groupings(remove_used(group, attributes)))
-        for set in group_sets:
-            yield set
+    positions = {item: position for position, item in enumerate(items)}
+    # positions of the items not used yet
+    unused = list(range(len(items)))
+    rank = 0
+    for place, item in enumerate(permutation):
+        digit = unused.index(positions[item])
+        rank += digit * math.factorial(len(items) - 1 - place)
+        unused.pop(digit)
+    return rank
+
+
+def unrank_permutation(rank, items):
+    """ Return the permutation of the items at the rank, see
+    rank_permutation().
+
+    >>> [unrank_permutation(rank, 'abc') for rank in range(6)] == list(itertools.permutations('abc'))
+    True
+    """
+    unused = list(items)
+    permutation = []
+    for place in range(len(items) - 1, -1, -1):
+        digit, rank = divmod(rank, math.factorial(place))
+        permutation.append(unused.pop(digit))
+    return tuple(permutation)
+
+
+def solve_shard(attributes, group_count, clues, start, stop):
+    """ Return list of the groupings numbered from start up to stop that
+    pass the constraints. Used by worker processes, which build the
+    constraints again from their clues.
+    """
+    constraints = Constraints(group_count)
+    for name, arguments in clues:
+        getattr(constraints, name)(*arguments)
+    return list(Solver(attributes, constraints).solve(start, stop))
+
+
+class Coordinator:
+    """ Splits all groupings of a puzzle into shards of consecutive
+    numbers and solves them in worker processes.
+
+    The matches of every solved shard are kept. A shard whose worker
+    failed is left out and run() can be called again to retry only the
+    shards that are missing. Constraints are sent to the workers as the
+    clues they were added with.
+
+    >>> attributes = [['a', 'b', 'c'], ['x', 'y', 'z'], ['1', '2', '3']]
+    >>> constraints = Constraints(3).adjacent('a', 'x').order('y', '3')
+    >>> coordinator = Coordinator(attributes, constraints, shards=5)
+    >>> coordinator.run(workers=2)
+    True
+    >>> coordinator.solutions() == list(Solver(attributes, constraints).solve())
+    True
+    """
+
+    def __init__(self, attributes, constraints, shards=None):
+        """ Initialize coordinator.
+
+        :param attributes: List of attribute groups, as for Solver
+        :param constraints: Constraints object
+        :param shards: Number of shards, by default four for every CPU
+        """
+        if len(constraints.clues) != len(constraints.constraints):
+            raise ValueError('Constraints not added with a Constraints method '
+                             'can\'t be sent to workers')
+        self.attributes = attributes
+        self.constraints = constraints
+        size = Solver(attributes, constraints).size()
+        if shards is None:
+            shards = 4 * (os.cpu_count() or 1)
+        step = max(-(-size // shards), 1)
+        # (start, stop) of every shard
+        self.shards = [(start, min(start + step, size)) for start in range(0, size, step)]
+        # shard -> list of its matches
+        self.matches = {}
+        # shard -> exception of the shards that failed in the last run
+        self.failed = {}
+
+    def run(self, workers=None):
+        """ Solve the shards not solved yet in a pool of that many worker
+        processes. Return True if every shard is solved.
+        """
+        self.failed = {}
+        pending = [shard for shard in self.shards if shard not in self.matches]
+        if not pending:
+            return True
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(solve_shard, self.attributes,
+                                       self.constraints.groupCount, self.constraints.clues,
+                                       start, stop): (start, stop)
+                       for start, stop in pending}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    self.matches[shard] = future.result()
+                except Exception as error:
+                    self.failed[shard] = error
+        return not self.failed
+
+    def solutions(self):
+        """ Return the matches of the solved shards, merged in the order
+        solve() produces them.
+        """
+        return [groups for shard in self.shards for groups in self.matches.get(shard, [])]
 
 
 class Constraints:
@@ -66,7 +279,8 @@ class Constraints:
     Data attribute 'constraints' contains a list of functions that that
     can be used to test if a a list of groups fulfills the constraints.
     Ordering of the group list matters: first item in the list is the 
-    leftmost group and last is the rightmost.
+    leftmost group and last is the rightmost. Each function lists the
+    attributes it tests in its 'attributes' attribute.
     
     If constraints are defined for attributes that don't exist in
     groups that are tested AttributeNotFoundException will be thrown
@@ -78,6 +292,9 @@ class Constraints:
 
         self.constraints = []
         self.groupCount = group_count
+        # (method name, arguments) of every constraint added, so worker
+        # processes can add them again
+        self.clues = []
 
     def together(self, attribute1, attribute2):
         """ Add constraint: Attributes belong in the same group."""
@@ -85,7 +302,9 @@ class Constraints:
             return attribute_group_index(groups, attribute1) == \
                    attribute_group_index(groups, attribute2)
 
+        together_test.attributes = (attribute1, attribute2)
         self.constraints.append(together_test)
+        self.clues.append(('together', (attribute1, attribute2)))
         return self
 
     def adjacent(self, attribute1, attribute2):
@@ -96,7 +315,9 @@ class Constraints:
             index2 = attribute_group_index(groups, attribute2)
             return abs(index1 - index2) == 1
 
+        adjacent_test.attributes = (attribute1, attribute2)
         self.constraints.append(adjacent_test)
+        self.clues.append(('adjacent', (attribute1, attribute2)))
         return self
 
     def order(self, left_attribute, right_attribute):
@@ -107,7 +328,9 @@ class Constraints:
             index2 = attribute_group_index(groups, right_attribute)
             return index2 - index1 == 1
 
+        order_test.attributes = (left_attribute, right_attribute)
         self.constraints.append(order_test)
+        self.clues.append(('order', (left_attribute, right_attribute)))
         return self
 
     def middle(self, attribute):
@@ -124,7 +347,9 @@ class Constraints:
             else:
                 return middle == index
 
+        middle_test.attributes = (attribute,)
         self.constraints.append(middle_test)
+        self.clues.append(('middle', (attribute,)))
         return self
 
 
@@ -146,3 +371,7 @@ def attribute_group_index(groups, attribute):
             return group[0]
     raise AttributeNotFoundException(
         'Attribute: %s not found in groups: %s' % (attribute, groups))
+
+
+if __name__ == '__main__':
+    doctest.testmod()
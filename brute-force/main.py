@@ -1,31 +1,36 @@
-# bruteforcing won't work because there are something like 24,883,200,000
-# combinations the houses could be in
-from solving import Solver, Constraints
+# there are something like 24,883,200,000 combinations the houses
+# could be in, but the solver checks constraints one category at a
+# time so most of them are never built
+from Solver import Solver, Constraints
 
-# colors = ['red', 'green', 'ivory', 'yellow', 'blue']
-# people = ['englishman', 'spaniard', 'ukrainian', 'norwegian', 'japanese']
-# drinks = ['coffee', 'tea', 'milk', 'orange juice', 'water']
-# pets = ['dog', 'snails', 'fox', 'horse', 'zebra']
-# tobacco = ['old gold', 'kool', 'chesterfield', 'lucky strike', 'parliament']
-# attributes = [colors, people, drinks, pets, tobacco]
+colors = ['red', 'green', 'ivory', 'yellow', 'blue']
+people = ['englishman', 'spaniard', 'ukrainian', 'norwegian', 'japanese']
+drinks = ['coffee', 'tea', 'milk', 'orange juice', 'water']
+pets = ['dog', 'snails', 'fox', 'horse', 'zebra']
+tobacco = ['old gold', 'kool', 'chesterfield', 'lucky strike', 'parliament']
+attributes = [colors, people, drinks, pets, tobacco]
 
-# constraints = Constraints(5) \
-#     .together('englishman', 'red') \
-#     .together('spaniard', 'dog') \
-#     .together('coffee', 'green') \
-#     .together('ukrainian', 'tea') \
-#     .order('ivory', 'green') \
-#     .together('old gold', 'snails') \
-#     .together('kool', 'yellow') \
-#     .middle('milk') \
-#     .together('norwegian', 0) \
-#     .adjacent('chesterfield', 'fox') \
-#     .adjacent('kool', 'horse') \
-#     .together('lucky strike', 'orange juice') \
-#     .together('japanese', 'parliament') \
-#     .adjacent('norwegian', 'blue')
-# solver = Solver(attributes, constraints)
-# solver.solve()
+constraints = Constraints(5) \
+    .together('englishman', 'red') \
+    .together('spaniard', 'dog') \
+    .together('coffee', 'green') \
+    .together('ukrainian', 'tea') \
+    .order('ivory', 'green') \
+    .together('old gold', 'snails') \
+    .together('kool', 'yellow') \
+    .middle('milk') \
+    .together('norwegian', 0) \
+    .adjacent('chesterfield', 'fox') \
+    .adjacent('kool', 'horse') \
+    .together('lucky strike', 'orange juice') \
+    .together('japanese', 'parliament') \
+    .adjacent('norwegian', 'blue')
+solver = Solver(attributes, constraints)
+for group in next(solver.solve()):
+    if 'water' in group:
+        print('The %s drinks water' % group[1])
+    if 'zebra' in group:
+        print('The %s owns the zebra' % group[1])
 
 # houses are numbered from left to right from 0 to 4
 
@@ -52,11 +57,9 @@ goldfish_constraints = Constraints(3) \
     .order('blue', 'green')
 
 solver = Solver(attributes, goldfish_constraints)
-answer = next(solver.apply_constraints())
+answer = next(solver.solve())
 for group in answer:
     if 'goldfish' in group:
         # Attributes in the answer group are in
         # the same order as in the input attributes
         print('The %s owns the goldfish' % group[0])
-
-
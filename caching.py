@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import doctest
+
+from solving import Constraints, Solver
+
+
+def fingerprint(attributes, constraints):
+    """ Return a fingerprint of the puzzle that doesn't depend on the
+    order of categories, attributes or clues.
+
+    The two attributes of symmetric clues, such as together and
+    adjacent, are sorted and repeated clues count once.
+
+    >>> attributes = [['red', 'blue'], ['cat', 'dog']]
+    >>> first = fingerprint(attributes, Constraints().together('red', 'cat').middle('dog'))
+    >>> second = fingerprint([['dog', 'cat'], ['blue', 'red']],
+    ...                      Constraints().middle('dog').together('cat', 'red'))
+    >>> first == second
+    True
+    >>> first == fingerprint(attributes, Constraints().order('red', 'cat'))
+    False
+    >>> apart = fingerprint(attributes, Constraints().apart('red', 'cat', 1))
+    >>> apart == fingerprint(attributes, Constraints().apart('cat', 'red', 1))
+    True
+    """
+    categories = sorted(tuple(sorted(names, key=repr)) for names in attributes)
+    clues = set()
+    for clue in constraints.clues:
+        arguments = tuple(clue)
+        if getattr(clue, 'symmetric', False):
+            arguments = tuple(sorted(arguments[:2], key=repr)) + arguments[2:]
+        clues.add((type(clue).__name__,) + arguments)
+    canonical = (len(attributes[0]), categories, sorted(clues, key=repr))
+    return hashlib.sha256(repr(canonical).encode('utf-8')).hexdigest()
+
+
+class SolutionCache:
+    """ Remembers solutions of puzzles by their fingerprint.
+
+    At most 'size' solutions are kept in memory, the least recently used
+    is dropped first. If 'path' is a directory, solutions are also
+    stored there as JSON files, one per puzzle, so they survive restarts.
+    Attribute names must then be strings.
+
+    A solution is stored as the group index of every attribute, so it
+    is returned in the caller's order of categories and attributes. If a
+    puzzle has more than one solution the first one found is cached.
+
+    >>> cache = SolutionCache(size=2)
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+    >>> constraints = Constraints().order('blue', 'green').together('dog', 'green') \\
+    ...     .together('cat', 0).adjacent('red', 'fish')
+    >>> cache.solve(attributes, constraints)
+    ([[['red'], ['cat']], [['blue'], ['fish']], [['green'], ['dog']]], True)
+    >>> cache.solve([['fish', 'dog', 'cat'], ['green', 'blue', 'red']], constraints)
+    ([[['cat'], ['red']], [['fish'], ['blue']], [['dog'], ['green']]], True)
+    >>> cache.hits, cache.misses
+    (1, 1)
+    >>> ordered = Constraints().order('red', 'blue')
+    >>> cache.solve(attributes, ordered, max_nodes=1)[1], len(cache)
+    (None, 1)
+    >>> cache.solve(attributes, ordered)[1]
+    True
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> SolutionCache(path=path).solve(attributes, constraints.middle('cat'))
+    ([], False)
+    >>> restarted = SolutionCache(path=path)
+    >>> restarted.solve(attributes, constraints), restarted.hits
+    (([], False), 1)
+    """
+
+    def __init__(self, size=1024, path=None):
+        self.size = size
+        self.path = path
+        # fingerprint -> {attribute: group index}, or None if unsolvable
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def solve(self, attributes, constraints, **options):
+        """ Return a solution as nested lists and a success flag like
+        Solver.solve(). Options are passed to Solver.solve() on a miss.
+        If a budget in them runs out, the flag is None and nothing is
+        cached.
+        """
+        key = fingerprint(attributes, constraints)
+        found, places = self.get(key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+            answer, solved = Solver(attributes, constraints).solve(**options)
+            if solved is None:
+                return answer, None
+            places = None
+            if solved:
+                places = {names[0]: index for index, group in enumerate(answer)
+                          for names in group}
+            self.put(key, places)
+        if places is None:
+            return [], False
+        answer = [[None] * len(attributes) for _ in attributes[0]]
+        for category, names in enumerate(attributes):
+            for name in names:
+                answer[places[name]][category] = [name]
+        return answer, True
+
+    def get(self, key):
+        """ Return whether the key is cached and its solution. """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return True, self.entries[key]
+        if self.path is not None:
+            try:
+                with open(self.file(key)) as stored:
+                    places = json.load(stored)
+            except (OSError, ValueError):
+                return False, None
+            self.remember(key, places)
+            return True, places
+        return False, None
+
+    def put(self, key, places):
+        """ Cache the solution of the key in memory and on disk. """
+        self.remember(key, places)
+        if self.path is not None:
+            # write a temporary file and rename it so readers never see
+            # a partial file
+            descriptor, temporary = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(descriptor, 'w') as stored:
+                json.dump(places, stored)
+            os.replace(temporary, self.file(key))
+
+    def remember(self, key, places):
+        self.entries[key] = places
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def __len__(self):
+        return len(self.entries)
+
+
+if __name__ == '__main__':
+    doctest.testmod()
@@ -0,0 +1,172 @@
+import itertools
+import math
+import doctest
+
+from solving import Constraints, LeftOf, Nogoods, Solver as SearchSolver
+
+
+def components(attributes, constraints):
+    """ Return list of (categories, Constraints) of parts of the puzzle
+    that share no clues. Categories are indexes into attributes.
+
+    Clues that name no attribute go with the first part.
+
+    >>> attributes = [['red', 'blue'], ['cat', 'dog'], ['tea', 'milk']]
+    >>> parts = components(attributes, Constraints().together('red', 'milk').middle('cat'))
+    >>> [(categories, part.clues) for categories, part in parts]
+    [([0, 2], [Together(attribute1='red', attribute2='milk')]), ([1], [Middle(attribute='cat')])]
+    """
+    categories = {name: category for category, names in enumerate(attributes)
+                  for name in names}
+    # union find over categories
+    parent = list(range(len(attributes)))
+
+    def root(category):
+        while parent[category] != category:
+            parent[category] = parent[parent[category]]
+            category = parent[category]
+        return category
+
+    placed = []
+    for clue in constraints.clues:
+        linked = [categories[value] for value in clue
+                  if not isinstance(value, int) and value in categories]
+        for category in linked[1:]:
+            parent[root(category)] = root(linked[0])
+        placed.append((clue, linked[0] if linked else None))
+    parts = {}
+    for category in range(len(attributes)):
+        parts.setdefault(root(category), []).append(category)
+    result = []
+    for members in parts.values():
+        part = Constraints()
+        for clue, category in placed:
+            if category is None and not result or \
+                    category is not None and root(category) == root(members[0]):
+                part.add(clue)
+        result.append((members, part))
+    return result
+
+
+def free_attributes(attributes, constraints):
+    """ Return list of attributes of each category named by no clue.
+    They can swap places in any solution.
+
+    >>> free_attributes([['red', 'blue', 'green'], ['cat', 'dog']], Constraints().middle('red'))
+    [['blue', 'green'], ['cat', 'dog']]
+    """
+    named = {value for clue in constraints.clues for value in clue
+             if not isinstance(value, int)}
+    return [[name for name in names if name not in named] for names in attributes]
+
+
+class Solver:
+    """ Solves the parts of a puzzle that share no clues separately.
+
+    Categories only meet through clues, so a solution of the puzzle is
+    any combination of solutions of its parts and the number of
+    solutions is their product. Attributes that no clue names can swap
+    places: the parts are solved with them kept in order, left to right,
+    and counts are multiplied by the number of their orderings. Options
+    are passed to the solving.Solver of every part. The searches of the
+    parts are interleaved, so each part learns into its own Nogoods with
+    the limit of the one given.
+
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish'], ['tea', 'milk', 'beer']]
+    >>> constraints = Constraints().order('red', 'blue').together('cat', 0)
+    >>> solver = Solver(attributes, constraints)
+    >>> [part[0] for part in solver.parts]
+    [[0], [1], [2]]
+    >>> solver.count_solutions(), SearchSolver(attributes, constraints).count_solutions()
+    (24, 24)
+    >>> solver.solve()
+    ([[['red'], ['cat'], ['tea']], [['blue'], ['dog'], ['milk']], [['green'], ['fish'], ['beer']]], True)
+    >>> attributes = [['a0', 'a1', 'a2', 'a3'], ['b0', 'b1', 'b2', 'b3'],
+    ...               ['c0', 'c1', 'c2', 'c3'], ['d0', 'd1', 'd2', 'd3']]
+    >>> constraints = Constraints().not_together('a0', 'b0').order('c1', 'd2') \\
+    ...     .order('a1', 'b0').adjacent('c1', 'd3').adjacent('a3', 'b2').adjacent('c3', 'd2')
+    >>> learning = SearchSolver(attributes, constraints, engine='components', nogoods=Nogoods())
+    >>> plain = SearchSolver(attributes, constraints)
+    >>> len(list(learning.iter_solutions())), len(list(plain.iter_solutions()))
+    (128, 128)
+    """
+
+    def __init__(self, attributes, constraints, nogoods=None, **options):
+        self.attributes = attributes
+        self.count = len(attributes[0])
+        free = free_attributes(attributes, constraints)
+        # (categories, solver, free attributes of each category) per part
+        self.parts = []
+        for categories, part in components(attributes, constraints):
+            part_free = [free[category] for category in categories]
+            for names in part_free:
+                for name1, name2 in zip(names, names[1:]):
+                    part.add(LeftOf(name1, name2))
+            if nogoods is not None:
+                options['nogoods'] = Nogoods(limit=nogoods.limit)
+            solver = SearchSolver([attributes[category] for category in categories], part,
+                                  **options)
+            self.parts.append((categories, solver, part_free))
+
+    def count_solutions(self, limit=None):
+        """ Return number of solutions, at most limit. """
+        count = 1
+        for _, solver, part_free in self.parts:
+            part_count = solver.count_solutions(limit)
+            if not part_count:
+                return 0
+            for names in part_free:
+                part_count *= math.factorial(len(names))
+            count *= part_count
+        return count if limit is None else min(count, limit)
+
+    def iter_solutions(self):
+        """ Yield every solution as nested lists. The parts after the first
+        are solved again for every solution of the parts before them.
+        """
+        for answers in self.combine(0):
+            answer = [[None] * len(self.attributes) for _ in range(self.count)]
+            for (categories, _, _), part_answer in zip(self.parts, answers):
+                for index, group in enumerate(part_answer):
+                    for category, names in zip(categories, group):
+                        answer[index][category] = names
+            yield answer
+
+    def combine(self, start):
+        if start == len(self.parts):
+            yield []
+            return
+        for answer in self.swaps(*self.parts[start]):
+            for rest in self.combine(start + 1):
+                yield [answer] + rest
+
+    def swaps(self, categories, solver, part_free):
+        """ Yield solutions of a part with its free attributes in every
+        order.
+        """
+        for answer in solver.iter_solutions():
+            # group indexes of the free attributes, left to right
+            places = [[index for index, group in enumerate(answer)
+                       if group[offset][0] in names]
+                      for offset, names in enumerate(part_free)]
+            orders = [itertools.permutations(names) for names in part_free]
+            for order in itertools.product(*orders):
+                swapped = [[names[:] for names in group] for group in answer]
+                for offset, names in enumerate(order):
+                    for index, name in zip(places[offset], names):
+                        swapped[index][offset] = [name]
+                yield swapped
+
+    def solve(self):
+        """ Return the first solution as nested lists and a success flag. """
+        solutions = self.iter_solutions()
+        try:
+            for answer in solutions:
+                return answer, True
+        finally:
+            solutions.close()
+        return [], False
+
+
+if __name__ == '__main__':
+    doctest.testmod()
@@ -0,0 +1,300 @@
+import doctest
+
+from solving import AttributeNotFoundException, Constraints, Middle
+
+
+class Solver:
+    """ Solves the same puzzles as solving.Solver as an exact cover
+    problem with Knuth's Algorithm X and dancing links.
+
+    Every (attribute, group index) pair is a row covering two columns:
+    the attribute, which must be in exactly one group, and the group's
+    slot for the attribute's category, which must hold exactly one
+    attribute. Rows that break a constraint on one attribute, like
+    middle or together with a group index, are left out. Constraints
+    between two attributes are side constraints: choosing a row hides
+    the rows it conflicts with. Covering, hiding and their undoing
+    relink the nodes in place.
+
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+    >>> constraints = Constraints().order('blue', 'green').together('dog', 'green') \\
+    ...     .together('cat', 0).adjacent('red', 'fish')
+    >>> Solver(attributes, constraints).solve()
+    ([[['red'], ['cat']], [['blue'], ['fish']], [['green'], ['dog']]], True)
+    >>> solver = Solver(attributes, Constraints().middle('red'))
+    >>> solver.count_solutions(limit=5), solver.count_solutions(), solver.count_solutions(limit=0)
+    (5, 12, 0)
+    >>> Solver([['a', 'b']], Constraints().adjacent('a', 'a').middle(0)).count_solutions()
+    0
+    """
+
+    def __init__(self, attributes, constraints):
+        self.attributes = attributes
+        self.count = len(attributes[0])
+        # attribute name -> (category, position)
+        self.ids = {name: (category, position)
+                    for category, names in enumerate(attributes)
+                    for position, name in enumerate(names)}
+        # allowed[name] is the bitmask of group indexes left for it
+        self.allowed = {name: (1 << self.count) - 1 for name in self.ids}
+        # (name1, name2, table) of constraints between two attributes
+        self.links = []
+        self.impossible = False
+        for clue in constraints.clues:
+            self.add(clue)
+        self.build()
+
+    def resolve(self, attribute):
+        """ Return the attribute, checking it exists. """
+        if isinstance(attribute, int):
+            if not 0 <= attribute < self.count:
+                raise AttributeNotFoundException(
+                    'Group index: %s not found in %s groups' % (attribute, self.count))
+        elif attribute not in self.ids:
+            raise AttributeNotFoundException(
+                'Attribute: %s not found in attributes: %s' % (attribute, self.attributes))
+        return attribute
+
+    def add(self, clue):
+        """ Narrow allowed group indexes or record a side constraint. """
+        indexes = range(self.count)
+        if isinstance(clue, Middle):
+            name = self.resolve(clue.attribute)
+            middle = 1 << self.count // 2
+            if self.count % 2 == 0:
+                middle |= 1 << (self.count // 2 - 1)
+            if isinstance(name, int):
+                self.impossible |= not middle >> name & 1
+            else:
+                self.allowed[name] &= middle
+            return
+        holds = getattr(clue, 'holds', None)
+        if holds is None:
+            raise TypeError('Constraint %r is not supported' % (clue,))
+        attribute1 = self.resolve(clue.attribute1)
+        attribute2 = self.resolve(clue.attribute2)
+        if isinstance(attribute1, int) and isinstance(attribute2, int):
+            self.impossible |= not holds(attribute1, attribute2)
+        elif isinstance(attribute2, int):
+            self.allowed[attribute1] &= sum(1 << index for index in indexes
+                                            if holds(index, attribute2))
+        elif isinstance(attribute1, int):
+            self.allowed[attribute2] &= sum(1 << index for index in indexes
+                                            if holds(attribute1, index))
+        elif attribute1 == attribute2:
+            # an attribute is only ever in one group
+            self.allowed[attribute1] &= sum(1 << index for index in indexes
+                                            if holds(index, index))
+        else:
+            table = [[holds(index1, index2) for index2 in indexes] for index1 in indexes]
+            self.links.append((attribute1, attribute2, table))
+
+    def build(self):
+        """ Build the dancing links matrix.
+
+        Node 0 is the root, nodes 1 to columns are the column headers and
+        each row adds two nodes. Arrays hold the left, right, up and down
+        neighbours, the column and the row of every node.
+        """
+        names = list(self.ids)
+        width = len(self.attributes)
+        columns = len(names) + self.count * width
+        self.left = list(range(-1, columns))
+        self.left[0] = columns
+        self.right = list(range(1, columns + 2))
+        self.right[columns] = 0
+        self.up = list(range(columns + 1))
+        self.down = list(range(columns + 1))
+        self.column = list(range(columns + 1))
+        self.row = [None] * (columns + 1)
+        self.size = [0] * (columns + 1)
+        # (name, group index) and first node of every row
+        self.rows = []
+        self.first = []
+        row_ids = {}
+        for number, name in enumerate(names):
+            category = self.ids[name][0]
+            for index in range(self.count):
+                if self.allowed[name] >> index & 1:
+                    row_ids[name, index] = len(self.rows)
+                    self.add_row((1 + number, 1 + len(names) + index * width + category),
+                                 (name, index))
+        # conflicts[row] lists rows that can't be chosen with it
+        conflicts = [set() for _ in self.rows]
+        for name1, name2, table in self.links:
+            for index1 in range(self.count):
+                for index2 in range(self.count):
+                    if table[index1][index2]:
+                        continue
+                    row1 = row_ids.get((name1, index1))
+                    row2 = row_ids.get((name2, index2))
+                    if row1 is not None and row2 is not None:
+                        conflicts[row1].add(row2)
+                        conflicts[row2].add(row1)
+        self.conflicts = [sorted(rows) for rows in conflicts]
+        # rows out of the matrix are counted up, 0 is in the matrix
+        self.removed = [0] * len(self.rows)
+        self.chosen = []
+
+    def add_row(self, columns, label):
+        number = len(self.rows)
+        self.rows.append(label)
+        first = len(self.column)
+        for offset, column in enumerate(columns):
+            node = first + offset
+            self.left.append(first + (offset - 1) % len(columns))
+            self.right.append(first + (offset + 1) % len(columns))
+            self.up.append(self.up[column])
+            self.down.append(column)
+            self.down[self.up[column]] = node
+            self.up[column] = node
+            self.column.append(column)
+            self.row.append(number)
+            self.size[column] += 1
+        self.first.append(first)
+
+    def cover(self, column):
+        right, left, up, down = self.right, self.left, self.up, self.down
+        right[left[column]] = right[column]
+        left[right[column]] = left[column]
+        node = down[column]
+        while node != column:
+            self.removed[self.row[node]] += 1
+            other = right[node]
+            while other != node:
+                up[down[other]] = up[other]
+                down[up[other]] = down[other]
+                self.size[self.column[other]] -= 1
+                other = right[other]
+            node = down[node]
+
+    def uncover(self, column):
+        right, left, up, down = self.right, self.left, self.up, self.down
+        node = up[column]
+        while node != column:
+            self.removed[self.row[node]] -= 1
+            other = left[node]
+            while other != node:
+                self.size[self.column[other]] += 1
+                up[down[other]] = other
+                down[up[other]] = other
+                other = left[other]
+            node = up[node]
+        right[left[column]] = column
+        left[right[column]] = column
+
+    def hide(self, row):
+        """ Take a row out of every column it is in. """
+        up, down = self.up, self.down
+        self.removed[row] += 1
+        node = first = self.first[row]
+        while True:
+            up[down[node]] = up[node]
+            down[up[node]] = down[node]
+            self.size[self.column[node]] -= 1
+            node = self.right[node]
+            if node == first:
+                break
+
+    def unhide(self, row):
+        up, down = self.up, self.down
+        first = self.first[row]
+        node = self.left[first]
+        while True:
+            self.size[self.column[node]] += 1
+            up[down[node]] = node
+            down[up[node]] = node
+            if node == first:
+                break
+            node = self.left[node]
+        self.removed[row] -= 1
+
+    def search(self):
+        """ Yield every time all columns are covered, the chosen rows are
+        in self.chosen.
+        """
+        right = self.right
+        if right[0] == 0:
+            yield self.chosen
+            return
+        # column with the fewest rows left
+        column = right[0]
+        best = column
+        while column != 0:
+            if self.size[column] < self.size[best]:
+                best = column
+                if not self.size[best]:
+                    return
+            column = right[column]
+        self.cover(best)
+        try:
+            node = self.down[best]
+            while node != best:
+                row = self.row[node]
+                other = self.right[node]
+                while other != node:
+                    self.cover(self.column[other])
+                    other = self.right[other]
+                hidden = [conflict for conflict in self.conflicts[row]
+                          if not self.removed[conflict]]
+                for conflict in hidden:
+                    self.hide(conflict)
+                self.chosen.append(row)
+                try:
+                    yield from self.search()
+                finally:
+                    # also undone when the generator is closed early
+                    self.chosen.pop()
+                    for conflict in reversed(hidden):
+                        self.unhide(conflict)
+                    other = self.left[node]
+                    while other != node:
+                        self.uncover(self.column[other])
+                        other = self.left[other]
+                node = self.down[node]
+        finally:
+            self.uncover(best)
+
+    def to_lists(self, chosen):
+        """ Return chosen rows in the nested list format of solving.Solver. """
+        answer = [[None] * len(self.attributes) for _ in range(self.count)]
+        for row in chosen:
+            name, index = self.rows[row]
+            answer[index][self.ids[name][0]] = [name]
+        return answer
+
+    def iter_solutions(self):
+        """ Yield every solution as nested lists. """
+        if self.impossible:
+            return
+        for chosen in self.search():
+            yield self.to_lists(chosen)
+
+    def solve(self):
+        """ Return the first solution as nested lists and a success flag. """
+        solutions = self.iter_solutions()
+        try:
+            for answer in solutions:
+                return answer, True
+        finally:
+            solutions.close()
+        return [], False
+
+    def count_solutions(self, limit=None):
+        """ Return number of solutions, at most limit. """
+        count = 0
+        if self.impossible or limit is not None and count >= limit:
+            return count
+        solutions = self.search()
+        try:
+            for _ in solutions:
+                count += 1
+                if limit is not None and count >= limit:
+                    break
+        finally:
+            solutions.close()
+        return count
+
+
+if __name__ == '__main__':
+    doctest.testmod()
@@ -24,12 +24,8 @@ constraints = Constraints() \
     .adjacent('norwegian', 'blue')
 
 solver = Solver(attributes, constraints)
-answer, _ = solver.solve()
-
 # People are defined in index 1
-for group in answer:
-    # print(group[1][0])
-    if ['water'] in group:
-        print("The {} drinks water.".format(group[1][0]))
-    if ['zebra'] in group:
-        print("The {} owns the zebra.".format(group[1][0]))
\ No newline at end of file
+answers = solver.query(['water', 'zebra'], 1)
+
+print("The {} drinks water.".format(answers['water']))
+print("The {} owns the zebra.".format(answers['zebra']))
@@ -1,193 +1,1499 @@
-from copy import deepcopy
-from collections import Counter
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import argparse
+import cProfile
+import hashlib
 import itertools
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
 import time
-import doctest
 
 
 class UnsolvableException(Exception):
     pass
 
 
+class AttributeNotFoundException(Exception):
+    pass
+
+
+class BudgetExceededException(Exception):
+    pass
+
+
+class Budget:
+    """ Limits a search to timeout seconds and max_nodes search nodes.
+
+    spend() is called for every node and raises BudgetExceededException
+    once either runs out. The clock starts when the budget is created.
+
+    >>> budget = Budget(max_nodes=1)
+    >>> budget.spend()
+    >>> budget.spend() # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    BudgetExceededException
+    """
+
+    def __init__(self, timeout=None, max_nodes=None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.max_nodes = max_nodes
+        self.nodes = 0
+
+    def spend(self):
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise BudgetExceededException('Searched {0} nodes'.format(self.max_nodes))
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceededException('Time ran out')
+
+
+class Checkpoint(namedtuple('Checkpoint', 'masks decisions solutions done puzzle',
+                            defaults=(b'',))):
+    """ Position of a search, see Solver.checkpoint() and Solver.resume().
+
+    masks are the groups the search started from, with the constraints
+    applied. decisions is the stack of (mask index, bit, untried bits)
+    of every node above the next node to explore: the branch taken and
+    the branches left. solutions is the number found before the
+    position and done is set once the search is finished. The current
+    groups aren't stored, they are rebuilt by taking the decisions again.
+    puzzle is the puzzle_digest of the attributes and clues searched, so
+    a checkpoint isn't resumed on another puzzle with the same masks.
+
+    to_bytes() packs it into a compact binary format that from_bytes()
+    reads back, on this machine or another.
+
+    >>> puzzle = puzzle_digest([['red', 'blue', 'green']], [])
+    >>> checkpoint = Checkpoint([0b111, 0b101, 0b010], [(1, 0b001, 0b100)], 2, False, puzzle)
+    >>> Checkpoint.from_bytes(checkpoint.to_bytes()) == checkpoint
+    True
+    >>> len(checkpoint.to_bytes())
+    48
+    """
+
+    MAGIC = b'EPZ\x02'
+    HEADER = struct.Struct('<4sB?QII16s')
+    DECISION = struct.Struct('<IH')
+
+    def to_bytes(self):
+        # every mask takes the same number of bytes
+        size = (max([mask.bit_length() for mask in self.masks] +
+                    [untried.bit_length() for _, _, untried in self.decisions] + [1]) + 7) // 8
+        data = [self.HEADER.pack(self.MAGIC, size, self.done, self.solutions,
+                                 len(self.masks), len(self.decisions), self.puzzle)]
+        data.extend(mask.to_bytes(size, 'little') for mask in self.masks)
+        for index, bit, untried in self.decisions:
+            data.append(self.DECISION.pack(index, bit.bit_length() - 1))
+            data.append(untried.to_bytes(size, 'little'))
+        return b''.join(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        try:
+            magic, size, done, solutions, mask_count, decision_count, puzzle = \
+                cls.HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('Not a checkpoint')
+        if magic != cls.MAGIC:
+            raise ValueError('Not a checkpoint')
+        offset = cls.HEADER.size
+        masks = []
+        for _ in range(mask_count):
+            masks.append(int.from_bytes(data[offset:offset + size], 'little'))
+            offset += size
+        decisions = []
+        for _ in range(decision_count):
+            index, position = cls.DECISION.unpack_from(data, offset)
+            offset += cls.DECISION.size
+            untried = int.from_bytes(data[offset:offset + size], 'little')
+            offset += size
+            decisions.append((index, 1 << position, untried))
+        if offset != len(data):
+            raise ValueError('Checkpoint is truncated or too long')
+        return cls(masks, decisions, solutions, done, puzzle)
+
+
+def puzzle_digest(attributes, clues):
+    """ Return 16 bytes identifying the attributes and clues in their
+    order. Unlike caching.fingerprint it changes when they are
+    reordered, as the masks and bits of a search do.
+
+    >>> clues = [Middle('red')]
+    >>> puzzle_digest([['red', 'blue']], clues) == puzzle_digest([['blue', 'red']], clues)
+    False
+    """
+    return hashlib.sha256(repr((attributes, list(clues))).encode()).digest()[:16]
+
+
+class Checkpoints:
+    """ Saves the position of a search to a file every interval seconds.
+
+    Passed to Solver.iter_solutions() or count_solutions(), it is called
+    for every node like a Budget, which it passes the calls on to. The
+    position is also saved when the budget runs out, when the search is
+    stopped between solutions and when it is finished. The file is
+    replaced in one step, so it always holds a whole checkpoint. A job
+    that was killed picks up from the last one:
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'count.checkpoint')
+    >>> attributes = [['red', 'blue', 'green', 'white'], ['cat', 'dog', 'fish', 'bird']]
+    >>> checkpoints = Checkpoints(path)
+    >>> solver = Solver(attributes, Constraints().adjacent('red', 'cat'))
+    >>> solver.count_solutions(limit=100, checkpoints=checkpoints)
+    100
+    >>> solver = Solver(attributes, Constraints().adjacent('red', 'cat'))
+    >>> solver.resume(checkpoints.load()).count_solutions(checkpoints=checkpoints)
+    216
+    >>> checkpoints.load().done
+    True
+    >>> Solver(attributes, Constraints().middle('red').together('red', 0)) \\
+    ...     .count_solutions(checkpoints=checkpoints), checkpoints.load().done
+    (0, True)
+    """
+
+    def __init__(self, path, interval=60.0):
+        self.path = path
+        self.interval = interval
+        self.solver = None
+        self.budget = None
+        self.due = None
+
+    def load(self):
+        """ Return the saved Checkpoint, or None if there is none. """
+        try:
+            with open(self.path, 'rb') as stored:
+                return Checkpoint.from_bytes(stored.read())
+        except FileNotFoundError:
+            return None
+
+    def start(self, solver, budget=None):
+        self.solver = solver
+        self.budget = budget
+        self.due = time.monotonic() + self.interval
+
+    def spend(self):
+        if self.budget is not None:
+            self.budget.spend()
+        if time.monotonic() >= self.due:
+            self.save()
+
+    def save(self):
+        """ Write the position of the solver's search to the file. """
+        data = self.solver.checkpoint().to_bytes()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary = tempfile.mkstemp(dir=directory)
+        with os.fdopen(descriptor, 'wb') as stored:
+            stored.write(data)
+        os.replace(temporary, self.path)
+        self.due = time.monotonic() + self.interval
+
+
+class Stats:
+    """ Counters and hooks for tracing a search.
+
+    nodes: search nodes visited, backtracks: nodes that failed,
+    max_depth: most branches taken on one path, fixpoints: calls to
+    apply_constraints, propagations: constraint calls. 'constraints'
+    maps each propagator to [calls, removals, seconds] of its calls;
+    removals counts masks it narrowed.
+
+    The optional hooks are called as on_branch(groups, index, bit, depth)
+    after a mask is narrowed to one bit, on_fail(groups, depth, error)
+    when a node fails and on_prune(constraint, groups, removals) when a
+    constraint narrows masks. Without Stats the solver only checks for
+    None, so tracing costs nothing when it's not used.
+
+    >>> depths = []
+    >>> stats = Stats(on_branch=lambda groups, index, bit, depth: depths.append(depth))
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+    >>> constraints = Constraints().order('red', 'blue').together('cat', 'blue')
+    >>> Solver(attributes, constraints, stats=stats).count_solutions()
+    4
+    >>> stats.as_dict()
+    {'nodes': 7, 'backtracks': 0, 'max_depth': 2, 'fixpoints': 8, 'propagations': 6}
+    >>> depths
+    [1, 2, 2, 1, 2, 2]
+    >>> sorted((repr(clue), calls, removals) for clue, calls, removals, _ in stats.report())[-2:]
+    [("Order(attribute1='red', attribute2='blue')", 3, 3), ("Together(attribute1='cat', attribute2='blue')", 3, 3)]
+    """
+
+    def __init__(self, on_branch=None, on_fail=None, on_prune=None):
+        self.nodes = 0
+        self.backtracks = 0
+        self.max_depth = 0
+        self.fixpoints = 0
+        self.propagations = 0
+        self.constraints = {}
+        self.on_branch = on_branch
+        self.on_fail = on_fail
+        self.on_prune = on_prune
+
+    def as_dict(self):
+        """ Return the counters as a dict. """
+        return {'nodes': self.nodes, 'backtracks': self.backtracks,
+                'max_depth': self.max_depth, 'fixpoints': self.fixpoints,
+                'propagations': self.propagations}
+
+    def report(self):
+        """ Return list of (constraint, calls, removals, seconds) sorted
+        by the time spent in each constraint, slowest first. Constraints
+        compiled from a clue are shown as the clue.
+        """
+        rows = sorted(self.constraints.items(), key=lambda item: -item[1][2])
+        return [(getattr(constraint, 'clue', constraint), calls, removals, seconds)
+                for constraint, (calls, removals, seconds) in rows]
+
+    def branch(self, groups, index, bit, depth):
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self.on_branch is not None:
+            self.on_branch(groups, index, bit, depth)
+
+    def fail(self, groups, depth, error):
+        self.backtracks += 1
+        if self.on_fail is not None:
+            self.on_fail(groups, depth, error)
+
+    def propagate(self, constraint, groups):
+        """ Call the constraint and record calls, removals and time. """
+        self.propagations += 1
+        size = len(groups.trail)
+        start = time.perf_counter()
+        try:
+            constraint(groups)
+        finally:
+            seconds = time.perf_counter() - start
+            removals = len(groups.trail) - size
+            counters = self.constraints.get(constraint)
+            if counters is None:
+                counters = self.constraints[constraint] = [0, 0, 0.0]
+            counters[0] += 1
+            counters[1] += removals
+            counters[2] += seconds
+            if removals and self.on_prune is not None:
+                self.on_prune(constraint, groups, removals)
+
+
 class Solver:
-    """ Can be used to solve logic puzzles such as Einsteins puzzle. """
-    def __init__(self, attributes, constraints):
+    """ Can be used to solve logic puzzles such as Einsteins puzzle.
+
+    engine picks what answers solve, iter_solutions and count_solutions:
+    'search' propagates and branches here, 'dlx' uses exactcover.Solver,
+    'numpy' vectorized.Solver and 'components' decomposing.Solver, which
+    searches parts of the puzzle that share no clues separately. The
+    other engines don't support workers, budgets, checkpoints or added
+    constraints and raise ValueError for them.
+
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+    >>> constraints = Constraints().order('blue', 'green').together('cat', 0)
+    >>> solver = Solver(attributes, constraints, engine='dlx')
+    >>> solver.count_solutions()
+    4
+    >>> solver.solve(max_nodes=1)
+    Traceback (most recent call last):
+    ...
+    ValueError: Workers and budgets need the search engine
+    """
+    def __init__(self, attributes, constraints, heuristic=None, stats=None, nogoods=None,
+                 engine='search', all_different=False):
         # list of attributes: [['att1','att2'],['otheratt1','otheratt2']]
         self.attributes = attributes
-        # list of functions>
-        self.constraints = constraints.constraints
-        self.groups = []
+        # optional AllDifferentPropagator for every category: fewer nodes,
+        # but each costs more and on generated puzzles it's slower
+        self.all_different = all_different
+        # list of propagators compiled from the clues
+        self.constraints = constraints.compile(attributes, all_different=all_different)
+        # watch_list of the constraints, rebuilt when they change
+        self.watches = watch_list(self.constraints)
+        # Constraints object, sent to worker processes. Copied so clues
+        # added to the solver don't change the caller's constraints.
+        self.definitions = Constraints()
+        self.definitions.clues = list(constraints.clues)
         # initialize with groups containing all attributes
-        self.groups = [deepcopy(attributes) for _ in range(len(attributes[0]))]
+        self.groups = Groups(attributes)
+        # function choosing the mask index to branch on:
+        # fewest_remaining, fixed_order or random_order
+        self.default_heuristic = heuristic is None
+        self.heuristic = heuristic
+        if heuristic is None:
+            self.heuristic = fewest_remaining(self.constraints)
+        # the constraints are applied to the groups once and kept there;
+        # failed is set if that showed the puzzle has no solution
+        self.ready = False
+        self.failed = False
+        # (trail mark, number of constraints, number of clues, ready,
+        # failed) for every push
+        self.levels = []
+        # optional Stats traced by searches in this process, workers
+        # don't report back
+        self.stats = stats
+        # optional Nogoods, learning from failures and backjumping
+        self.nogoods = nogoods
+        # decision stack of the search in this process, the groups it
+        # started from and the number of solutions it found, see
+        # checkpoint(). yielded is set while it waits at a solution.
+        self.frontier = None
+        self.root = None
+        self.found = 0
+        self.yielded = False
+        self.done = False
+        # Checkpoint the next search continues from, see resume()
+        self.resumed = None
+        # solver of another engine, imported here as they import this module
+        if engine == 'search':
+            self.engine = None
+        elif engine == 'dlx':
+            import exactcover
+            self.engine = exactcover.Solver(attributes, constraints)
+        elif engine == 'numpy':
+            import vectorized
+            self.engine = vectorized.Solver(attributes, constraints)
+        elif engine == 'components':
+            import decomposing
+            self.engine = decomposing.Solver(attributes, constraints, heuristic=heuristic,
+                                             stats=stats, nogoods=nogoods,
+                                             all_different=all_different)
+        else:
+            raise ValueError('Unknown engine: {0}'.format(engine))
 
-    def solve(self):
-        apply_constraints(self.constraints, self.groups)
-        return try_to_solve(self.constraints, self.groups)
+    def solve(self, workers=None, depth=2, timeout=None, max_nodes=None):
+        """ Return the first solution as nested lists and a success flag.
 
+        With workers, subtrees below the search depth are solved in a pool
+        of that many processes and the first solution found wins.
 
-def try_to_solve(constraints, groups, start_offset=0):
-    """ Try to recursively solve the puzzle."""
-    original_copy = deepcopy(groups)
-    try:
-        apply_constraints(constraints, groups)
-    except UnsolvableException:
+        If timeout seconds or max_nodes search nodes run out before the
+        search finishes, the flag is None and instead of a solution the
+        groups narrowed by the constraints are returned: attributes
+        removed from a group can't be there in any solution. The budget
+        only applies to searching in this process.
+
+        >>> solver = Solver([['red', 'blue', 'green'], ['cat', 'dog', 'fish']],
+        ...                 Constraints().together('cat', 0).order('red', 'blue'))
+        >>> solver.solve(max_nodes=1)
+        ([[['red', 'green'], ['cat']], [['red', 'blue', 'green'], ['dog', 'fish']], [['blue', 'green'], ['dog', 'fish']]], None)
+        >>> solver.solve(max_nodes=10)[1]
+        True
+        >>> solver.solve(workers=2, depth=1)[1]
+        True
+        """
+        if self.engine is not None:
+            if workers or timeout is not None or max_nodes is not None:
+                raise ValueError('Workers and budgets need the search engine')
+            return self.engine.solve()
+        if workers:
+            if timeout is not None or max_nodes is not None:
+                raise ValueError('Budget is not supported with workers')
+            solutions = self.parallel_solutions(workers, depth, limit=1)
+        elif timeout is not None or max_nodes is not None:
+            solutions = self.iter_solutions(budget=Budget(timeout, max_nodes))
+        else:
+            solutions = self.iter_solutions()
+        try:
+            for answer in solutions:
+                return answer, True
+        except BudgetExceededException:
+            return self.groups.to_lists(), None
+        finally:
+            solutions.close()
         return [], False
 
-    flattened = flatten_groups(groups)
-    if len(flattened) == len(set(flattened)):
-        return groups, True
-    copy = deepcopy(groups)
-    offset = start_offset
-    # Offsets to skip
-    skip_offsets = set()
-    # Offsets to return
-    return_skip_offsets = generate_skip_offsets(original_copy, copy)
-    while True:
-        if offset in skip_offsets:
-            offset += 1
-            continue
-        if remove_possibility(copy, offset):
-            result, success = try_to_solve(constraints, copy, offset)
-            if success:
-                return result, True
+    def iter_solutions(self, workers=None, depth=2, budget=None, checkpoints=None):
+        """ Yield every solution as nested lists as soon as it's found.
+
+        Solutions are not stored. Groups are restored when the generator
+        is exhausted or closed. With workers, see parallel_solutions, the
+        solutions come in batches in no particular order. The optional
+        Budget raises BudgetExceededException when it runs out. The
+        position of the search is saved by the optional Checkpoints.
+
+        >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+        >>> solver = Solver(attributes, Constraints().order('red', 'blue'))
+        >>> solutions = solver.iter_solutions(workers=2, depth=1)
+        >>> sorted(solutions) == sorted(solver.iter_solutions())
+        True
+        """
+        if self.engine is not None:
+            if workers or budget is not None or checkpoints is not None:
+                raise ValueError('Workers, budgets and checkpoints need the search engine')
+            yield from self.engine.iter_solutions()
+            return
+        if workers:
+            if checkpoints is not None or self.resumed is not None:
+                raise ValueError('Checkpoints are not supported with workers')
+            yield from self.parallel_solutions(workers, depth)
+            return
+        for groups in self.run(budget, checkpoints):
+            yield groups.to_lists()
+
+    def count_solutions(self, limit=None, workers=None, depth=2, checkpoints=None):
+        """ Return number of solutions, stopping early at limit.
+
+        A puzzle has a unique answer if count_solutions(limit=2) is 1.
+        After resume() the solutions found before the checkpoint are
+        counted too. The position of the search is saved by the optional
+        Checkpoints.
+
+        >>> solver = Solver([['red', 'blue', 'green'], ['cat', 'dog', 'fish']], Constraints())
+        >>> solver.count_solutions(limit=0), solver.count_solutions(limit=5)
+        (0, 5)
+        >>> solver.count_solutions(workers=2), solver.count_solutions(limit=5, workers=2)
+        (36, 5)
+        """
+        if self.engine is not None:
+            if workers or checkpoints is not None:
+                raise ValueError('Workers and checkpoints need the search engine')
+            return self.engine.count_solutions(limit)
+        count = 0
+        if workers:
+            if checkpoints is not None or self.resumed is not None:
+                raise ValueError('Checkpoints are not supported with workers')
+            counts = self.parallel_solutions(workers, depth, limit, count_only=True)
+            try:
+                for subtree_count in counts:
+                    count += subtree_count
+                    if limit is not None and count >= limit:
+                        return limit
+            finally:
+                counts.close()
+            return count
+        if limit is not None and self.prepare():
+            # solutions found before the checkpoint may already reach it
+            found = 0 if self.resumed is None else self.resumed.solutions
+            if found >= limit:
+                self.resumed = None
+                return max(limit, 0)
+        solutions = self.run(checkpoints=checkpoints)
+        try:
+            for _ in solutions:
+                if limit is not None and self.found >= limit:
+                    break
+        finally:
+            solutions.close()
+        return self.found
+
+    def query(self, attributes, category):
+        """ Return dict of each attribute to the attribute of the category
+        in the same group, or to None if that differs between solutions.
+        Return None if the puzzle has no solution.
+
+        One search answers the query. Its first solution shows one
+        exists and gives the only possible answers. The search then goes
+        on for solutions that give another answer, skipping subtrees
+        where every attribute still open is fixed to its answer, and
+        stops once each has one or the tree is exhausted.
+
+        >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+        >>> solver = Solver(attributes, Constraints().together('cat', 0).order('red', 'blue'))
+        >>> solver.query(['cat', 'fish'], 0)
+        {'cat': None, 'fish': None}
+        >>> solver.add(Together('dog', 'blue')).query(['red', 'green'], 1)
+        {'red': None, 'green': None}
+        >>> solver.add(Middle('red')).query(['cat', 'red', 'fish'], 0)
+        {'cat': 'green', 'red': 'red', 'fish': 'red'}
+        >>> constraints = Constraints().not_together('a1', 0).together('a0', 'a1')
+        >>> print(Solver([['a0', 'a1', 'a2']], constraints).query(['a2'], 0))
+        None
+        """
+        if self.engine is not None:
+            raise ValueError('Queries need the search engine')
+        if not self.prepare():
+            return None
+        answers = {attribute: self.linked(attribute, category) for attribute in attributes}
+        open_attributes = [attribute for attribute, linked in answers.items() if linked is None]
+        self.push()
+        counter = CounterexamplePropagator(self.groups, category, open_attributes)
+        self.constraints.append(counter)
+        self.watches = watch_list(self.constraints)
+        solved = False
+        solutions = self.run()
+        try:
+            for _ in solutions:
+                if not solved:
+                    solved = True
+                    for attribute in open_attributes:
+                        answer = answers[attribute] = self.linked(attribute, category)
+                        if answer != attribute:
+                            counter.answers[attribute] = (self.groups.ids[attribute],
+                                                          self.groups.ids[answer][1])
+                else:
+                    for attribute in list(counter.answers):
+                        if self.linked(attribute, category) != answers[attribute]:
+                            answers[attribute] = None
+                            del counter.answers[attribute]
+                if not counter.answers:
+                    break
+        finally:
+            solutions.close()
+            self.pop()
+        return answers if solved else None
+
+    def linked(self, attribute, category):
+        """ Return the attribute of the category in the group of the
+        attribute if the groups fix it, otherwise None.
+        """
+        groups = self.groups
+        if attribute not in groups.ids:
+            raise AttributeNotFoundException(
+                'Attribute: %s not found in attributes: %s' % (attribute, self.attributes))
+        positions = groups.positions(attribute)
+        if positions & (positions - 1):
+            return None
+        mask = groups.masks[(positions.bit_length() - 1) * groups.width + category]
+        if mask & (mask - 1):
+            return None
+        return groups.name(category, mask)
+
+    def prepare(self):
+        """ Apply the constraints to the groups unless already done.
+
+        Return False if the puzzle has no solution.
+        """
+        if not self.ready and not self.failed:
+            try:
+                apply_constraints(self.constraints, self.groups, stats=self.stats,
+                                  watches=self.watches)
+            except UnsolvableException:
+                self.failed = True
+            self.ready = True
+        return not self.failed
+
+    def push(self):
+        """ Save the state so constraints added after it can be removed
+        with pop().
+
+        >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+        >>> solver = Solver(attributes, Constraints().order('red', 'blue'))
+        >>> solver.count_solutions()
+        12
+        >>> solver.push()
+        >>> solver.add(Together('cat', 'blue')).count_solutions()
+        4
+        >>> solver.push()
+        >>> solver.add(Together('cat', 'red')).count_solutions()
+        0
+        >>> solver.pop()
+        >>> solver.pop()
+        >>> solver.count_solutions()
+        12
+        """
+        if self.engine is not None:
+            raise ValueError('Added constraints need the search engine')
+        self.levels.append((self.groups.mark(), len(self.constraints),
+                            len(self.definitions.clues), self.ready, self.failed))
+
+    def add(self, clue):
+        """ Add a constraint record and return the solver.
+
+        If the constraints are already applied, only the new constraint
+        and the removals it causes are propagated.
+        """
+        if self.engine is not None:
+            raise ValueError('Added constraints need the search engine')
+        propagator = clue.compile(self.groups)
+        propagator.clue = clue
+        self.constraints.append(propagator)
+        self.definitions.add(clue)
+        self.watches = watch_list(self.constraints)
+        self.update_heuristic()
+        self.forget()
+        if self.ready and not self.failed:
+            try:
+                propagator(self.groups)
+                apply_constraints(self.constraints, self.groups, changed_only=True,
+                                  stats=self.stats, watches=self.watches)
+            except UnsolvableException:
+                self.failed = True
+        return self
+
+    def pop(self):
+        """ Remove the constraints added since the last push() and restore
+        the groups.
+
+        >>> solver = Solver([['a0', 'a1'], ['b0', 'b1']], Constraints(), nogoods=Nogoods())
+        >>> solver.push()
+        >>> solver.add(NotTogether('a0', 'b0')).add(NotTogether('a0', 'b1')).count_solutions()
+        0
+        >>> solver.pop()
+        >>> solver.count_solutions()
+        4
+        """
+        mark, constraint_count, clue_count, self.ready, self.failed = self.levels.pop()
+        self.groups.undo(mark)
+        del self.constraints[constraint_count:]
+        del self.definitions.clues[clue_count:]
+        self.watches = watch_list(self.constraints)
+        self.update_heuristic()
+        self.forget()
+
+    def forget(self):
+        """ Drop learned nogoods, they were learned under other
+        constraints.
+        """
+        if self.nogoods is not None:
+            self.nogoods.learned.clear()
+
+    def update_heuristic(self):
+        if self.default_heuristic:
+            self.heuristic = fewest_remaining(self.constraints)
+
+    def checkpoint(self):
+        """ Return the position of the search in this process as a
+        Checkpoint, to be given to resume().
+
+        While iter_solutions waits at a solution the position is after
+        it. When no search has started, it is the start.
+
+        >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+        >>> solver = Solver(attributes, Constraints().order('red', 'blue'))
+        >>> solutions = solver.iter_solutions()
+        >>> first = next(solutions)
+        >>> data = solver.checkpoint().to_bytes()
+        >>> solutions.close()
+        >>> resumed = Solver(attributes, Constraints().order('red', 'blue'))
+        >>> rest = list(resumed.resume(Checkpoint.from_bytes(data)).iter_solutions())
+        >>> len(rest), first in rest
+        (11, False)
+        >>> resumed.checkpoint().done, resumed.checkpoint().solutions
+        (True, 12)
+        """
+        if self.engine is not None:
+            raise ValueError('Checkpoints need the search engine')
+        if self.nogoods is not None:
+            raise ValueError('Searches learning nogoods have no checkpoints')
+        if self.failed:
+            return Checkpoint(self.groups.masks[:], (), 0, True, self.digest())
+        if self.frontier is None:
+            if self.resumed is not None:
+                return self.resumed
+            self.prepare()
+            return Checkpoint(self.groups.masks[:], (), 0, self.failed, self.digest())
+        decisions = [tuple(decision) for decision in self.frontier]
+        done = self.done
+        if self.yielded:
+            # the solution is done, the position is the next branch
+            while decisions and not decisions[-1][2]:
+                decisions.pop()
+            if decisions:
+                index, _, untried = decisions[-1]
+                bit = untried & -untried
+                decisions[-1] = (index, bit, untried ^ bit)
             else:
-                copy = deepcopy(groups)
-                skip_offsets.update(result)
-                offset += 1
+                done = True
+        return Checkpoint(self.root[:], decisions, self.found, done, self.digest())
+
+    def digest(self):
+        """ Return the puzzle_digest of the attributes, clues and the
+        all_different option, which changes the search tree too.
+        """
+        return puzzle_digest(self.attributes, self.definitions.clues + [self.all_different])
+
+    def resume(self, checkpoint):
+        """ Make the next search continue from the Checkpoint and return
+        the solver. The solver must have the same attributes and
+        constraints as the one the checkpoint was taken from, otherwise
+        the search raises ValueError.
+
+        >>> attributes = [['red', 'blue', 'green', 'white'], ['cat', 'dog', 'fish', 'bird']]
+        >>> solver = Solver(attributes, Constraints().adjacent('red', 'cat'))
+        >>> solver.count_solutions(limit=2)
+        2
+        >>> other = Solver(attributes, Constraints().not_together('blue', 'fish'))
+        >>> other.resume(solver.checkpoint()).count_solutions()
+        Traceback (most recent call last):
+        ...
+        ValueError: Checkpoint is from another puzzle
+        """
+        if self.engine is not None:
+            raise ValueError('Checkpoints need the search engine')
+        if self.nogoods is not None:
+            raise ValueError('Searches learning nogoods can\'t resume')
+        self.resumed = checkpoint
+        return self
+
+    def run(self, budget=None, checkpoints=None):
+        """ Yield solved groups of a search from the start, or from the
+        checkpoint given to resume(), keeping its position up to date for
+        checkpoint(). Constraints are applied to the groups first, if they
+        show there is no solution the search is finished at once.
+        """
+        checkpoint, self.resumed = self.resumed, None
+        if not self.prepare():
+            self.found = 0
+            if checkpoints is not None:
+                checkpoints.start(self, budget)
+                checkpoints.save()
+            return
+        if checkpoint is None:
+            checkpoint = Checkpoint(self.groups.masks[:], (), 0, False, self.digest())
+        elif checkpoint.puzzle != self.digest() or list(checkpoint.masks) != self.groups.masks:
+            raise ValueError('Checkpoint is from another puzzle')
+        if self.nogoods is None:
+            self.frontier = [list(decision) for decision in checkpoint.decisions]
+        elif checkpoints is not None:
+            raise ValueError('Searches learning nogoods have no checkpoints')
+        self.root = list(checkpoint.masks)
+        self.found = checkpoint.solutions
+        self.done = checkpoint.done
+        self.yielded = False
+        if checkpoints is not None:
+            checkpoints.start(self, budget)
+            budget = checkpoints
+        mark = self.groups.mark()
+        # the position is known when waiting at a solution, when the
+        # budget ran out before a node and when the search is finished
+        known = True
+        try:
+            if not self.done:
+                for groups in self.search(budget):
+                    self.found += 1
+                    self.yielded = True
+                    yield groups
+                    self.yielded = False
+                self.done = True
+        except BaseException as error:
+            known = self.yielded or isinstance(error, BudgetExceededException)
+            raise
+        finally:
+            self.groups.undo(mark)
+            if checkpoints is not None and known:
+                checkpoints.save()
+
+    def search(self, budget=None):
+        """ Return generator of solved groups, with constraints already
+        applied to the groups. Learns nogoods if the solver has them.
+        """
+        if self.nogoods is None:
+            return search(self.constraints, self.groups, self.heuristic, stats=self.stats,
+                          budget=budget, frontier=self.frontier, watches=self.watches)
+        self.nogoods.start(self.constraints, self.groups, self.watches)
+        return learning_search(self.constraints, self.groups, self.nogoods, self.heuristic,
+                               self.stats, budget=budget, watches=self.watches)
+
+    def parallel_solutions(self, workers, depth=2, limit=None, count_only=False, batch=100):
+        """ Yield solutions found by a pool of worker processes.
+
+        The search tree is expanded here to the depth and every open
+        subtree is searched by a worker, which rebuilds the constraints
+        from the pickled Constraints object and branches with
+        fewest_remaining. A worker returns at most batch solutions and a
+        Checkpoint of where it stopped, the subtree is then sent again
+        from the checkpoint. Solutions are yielded as batches finish, so
+        they are never all stored. The search of a subtree stops after
+        limit solutions. With count_only the number of solutions of each
+        batch is yielded instead, and batches count 100 times as many.
+
+        Closing the generator cancels the batches not yet started, the
+        running ones finish their batch.
+        """
+        if limit is not None and limit <= 0 or not self.prepare():
+            return
+        if count_only:
+            batch *= 100
+        executor = ProcessPoolExecutor(workers)
+        # future -> number of solutions found in its subtree before it
+        pending = {}
+
+        def submit(masks, found, checkpoint=None):
+            size = batch if limit is None else min(batch, limit - found)
+            future = executor.submit(solve_subtree, self.attributes, self.definitions,
+                                     masks, size, count_only, checkpoint, self.all_different)
+            pending[future] = masks, found
+
+        finished = False
+        try:
+            mark = self.groups.mark()
+            try:
+                for groups in search(self.constraints, self.groups, self.heuristic, depth,
+                                     self.stats, watches=self.watches):
+                    if groups.solved():
+                        yield 1 if count_only else groups.to_lists()
+                    else:
+                        submit(groups.masks[:], 0)
+            except UnsolvableException:
+                return
+            finally:
+                self.groups.undo(mark)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    masks, found = pending.pop(future)
+                    solutions, checkpoint = future.result()
+                    found += solutions if count_only else len(solutions)
+                    if checkpoint is not None and (limit is None or found < limit):
+                        submit(masks, found, checkpoint)
+                    if count_only:
+                        yield solutions
+                    else:
+                        yield from solutions
+            finished = True
+        finally:
+            executor.shutdown(wait=finished, cancel_futures=not finished)
+
+
+def solve_subtree(attributes, constraints, masks, limit=None, count_only=False,
+                  checkpoint=None, all_different=False):
+    """ Search the subtree starting from the masks. Used by worker processes.
+
+    Return list of solutions as nested lists, or their number if
+    count_only is set, and the Checkpoint to continue from. Stop after
+    limit solutions. The checkpoint is None if the subtree is finished.
+    The search continues from the optional checkpoint. all_different
+    is passed to the Solver.
+
+    >>> constraints = Constraints().order('red', 'blue')
+    >>> solutions, checkpoint = solve_subtree([['red', 'blue', 'green']], constraints,
+    ...                                       [0b111, 0b111, 0b111], limit=1)
+    >>> solutions
+    [[[['red']], [['blue']], [['green']]]]
+    >>> solve_subtree([['red', 'blue', 'green']], constraints, [0b111, 0b111, 0b111],
+    ...               checkpoint=checkpoint)
+    ([[[['green']], [['red']], [['blue']]]], None)
+    """
+    solver = Solver(attributes, constraints, all_different=all_different)
+    solver.groups.masks = list(masks)
+    solver.groups.reindex()
+    if checkpoint is not None:
+        solver.resume(checkpoint)
+    solutions = []
+    count = 0
+    found = solver.run()
+    try:
+        for groups in found:
+            count += 1
+            if not count_only:
+                solutions.append(groups.to_lists())
+            if count == limit:
+                checkpoint = solver.checkpoint()
+                break
         else:
-            # This path was exhausted
-            return return_skip_offsets, False
+            checkpoint = None
+    finally:
+        found.close()
+    if checkpoint is not None and checkpoint.done:
+        checkpoint = None
+    return count if count_only else solutions, checkpoint
+
 
+def iterate_bits(mask):
+    """ Yield every set bit of the mask from the lowest.
 
-def generate_skip_offsets(groups1, groups2):
-    """ Return list of offsets to skip for function remove_possibility.
+    >>> list(iterate_bits(0b1010))
+    [2, 8]
+    """
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
 
-    If remove_possibility is called with group1 and all the offsets from the
-    return value starting from the last, the result will be group2.
 
-    group2 must be same as group1 with some values removed. Else return nonsense.
+def bit_count(mask):
+    """ Return number of set bits in the mask.
 
-    >>> groups1 = [[['cat', 'dog', 'bat']]]
-    >>> groups2 = [[['dog']]]
-    >>> skips = generate_skip_offsets(groups1, groups2)
-    >>> skips
-    [0, 2]
-    >>> remove_possibility(groups1, skips[1])
-    True
-    >>> remove_possibility(groups1, skips[0])
-    True
-    >>> groups1 == groups2
-    True
-    >>> groups3 = [[['cat', 'dog'], ['red', 'blue']], [['horse'], ['red', 'blue']], [['bat']]]
-    >>> groups4 = [[['dog'], ['blue']], [['horse'], ['red']],[['bat']]]
-    >>> generate_skip_offsets(groups3, groups4)
-    [0, 2, 5]
-    >>> groups5 = [[['dog'], ['blue']], [['horse'], ['red', 'blue', 'green']]]
-    >>> groups6 = [[['dog'], ['blue']], [['horse'], ['green']]]
-    >>> generate_skip_offsets(groups5, groups6)
-    [0, 1]
-
-    # first list must be longer
-    >>> generate_skip_offsets([[['mad']]], [[['bat', 'cat']]]) # doctest: +IGNORE_EXCEPTION_DETAIL
+    >>> bit_count(0b1011)
+    3
+    """
+    return bin(mask).count('1')
+
+
+class Groups:
+    """ Possible attributes of every group stored as integer bitmasks.
+
+    Attribute names are interned once: each name maps to its category
+    index and a bit inside that category. masks[group * width + category]
+    has a bit set for every attribute of that category still possible
+    in the group. Sets of group indexes are bitmasks as well, bit 0 being
+    the leftmost group. A number used as an attribute is a group index.
+
+    places[category][position] is the reverse index: bitmask of group
+    indexes where the attribute can still be. It is updated on every
+    removal and undo, so looking up positions doesn't scan the groups.
+
+    >>> groups = Groups([['red', 'blue'], ['cat', 'dog']])
+    >>> groups.remove(0b01, 'red')
+    >>> groups.to_lists()
+    [[['blue'], ['cat', 'dog']], [['red', 'blue'], ['cat', 'dog']]]
+    >>> bin(groups.positions('red')), bin(groups.positions('cat'))
+    ('0b10', '0b11')
+    >>> groups.remove(0b01, 'blue') # doctest: +IGNORE_EXCEPTION_DETAIL
     Traceback (most recent call last):
     ...
-    ValueError
-    >>> generate_skip_offsets([[['cat']]], [[['cat']]])
-    []
-    """
-    copy1 = deepcopy(groups1)
-    copy2 = deepcopy(groups2)
-
-    # remove singleton lists because function remove_possibility skips them
-    for group1, group2 in zip(copy1, copy2):
-        for attributes1, attributes2 in zip(group1, group2):
-            if len(attributes1) == 1:
-                attributes1.clear()
-                attributes2.clear()
-
-    flattened1 = flatten_groups(copy1)
-    flattened2 = flatten_groups(copy2)
-    if len(flattened1) < len(flattened2):
-        raise ValueError("First group is shorter than second.")
-
-    missing_attribute_indexes = []
-    offset = 0
-    next_index = 0
-    for i, attribute in enumerate(flattened1):
+    UnsolvableException
+    """
+
+    def __init__(self, attributes, count=None):
+        self.attributes = attributes
+        self.width = len(attributes)
+        self.count = len(attributes[0]) if count is None else count
+        # bitmask containing every group index
+        self.full = (1 << self.count) - 1
+        # attribute name -> (category, bit)
+        self.ids = {}
+        for category, names in enumerate(attributes):
+            for position, name in enumerate(names):
+                self.ids[name] = (category, 1 << position)
+        self.masks = [(1 << len(names)) - 1
+                      for _ in range(self.count) for names in attributes]
+        self.reindex()
+        # (mask index, removed bits) not yet seen by apply_constraints
+        self.events = []
+        # every (mask index, removed bits) so removals can be undone
+        self.trail = []
+
+    @classmethod
+    def from_lists(cls, groups):
+        """ Create groups from nested lists, mostly useful for testing.
+
+        Categories are collected from the lists in the order attributes
+        are first seen.
+        """
+        width = max(len(group) for group in groups)
+        attributes = [[] for _ in range(width)]
+        for group in groups:
+            for category, names in enumerate(group):
+                for name in names:
+                    if name not in attributes[category]:
+                        attributes[category].append(name)
+        instance = cls(attributes, len(groups))
+        for index, group in enumerate(groups):
+            for category in range(width):
+                mask = 0
+                for name in (group[category] if category < len(group) else []):
+                    mask |= instance.ids[name][1]
+                instance.masks[index * width + category] = mask
+        instance.reindex()
+        return instance
+
+    def reindex(self):
+        """ Rebuild the reverse index from the masks. """
+        masks = self.masks
+        width = self.width
+        self.places = [[0] * len(names) for names in self.attributes]
+        for index, mask in enumerate(masks):
+            places = self.places[index % width]
+            group_bit = 1 << index // width
+            while mask:
+                bit = mask & -mask
+                places[bit.bit_length() - 1] |= group_bit
+                mask ^= bit
+
+    def __len__(self):
+        return self.count
+
+    def copy(self):
+        """ Return a copy sharing the interned attributes. The copy starts
+        with an empty trail.
+        """
+        clone = object.__new__(Groups)
+        clone.__dict__.update(self.__dict__)
+        clone.masks = self.masks[:]
+        clone.places = [places[:] for places in self.places]
+        clone.events = self.events[:]
+        clone.trail = []
+        return clone
+
+    def mark(self):
+        """ Return a mark of the current state for undo. """
+        return len(self.trail)
+
+    def undo(self, mark):
+        """ Restore attributes removed after the mark.
+
+        >>> groups = Groups([['red', 'blue']])
+        >>> mark = groups.mark()
+        >>> groups.keep(0, 'red')
+        >>> groups.to_lists()
+        [[['red']], [['red', 'blue']]]
+        >>> groups.undo(mark)
+        >>> groups.to_lists()
+        [[['red', 'blue']], [['red', 'blue']]]
+        """
+        trail = self.trail
+        masks = self.masks
+        width = self.width
+        while len(trail) > mark:
+            index, bits = trail.pop()
+            masks[index] |= bits
+            places = self.places[index % width]
+            group_bit = 1 << index // width
+            while bits:
+                bit = bits & -bits
+                places[bit.bit_length() - 1] |= group_bit
+                bits ^= bit
+        del self.events[:]
+
+    def to_lists(self):
+        """ Return groups in the nested list format.
+
+        >>> Groups([['red', 'blue'], ['cat', 'dog']]).to_lists()
+        [[['red', 'blue'], ['cat', 'dog']], [['red', 'blue'], ['cat', 'dog']]]
+        """
+        masks = self.masks
+        width = self.width
+        return [[[name for position, name in enumerate(names)
+                  if masks[index * width + category] >> position & 1]
+                 for category, names in enumerate(self.attributes)]
+                for index in range(self.count)]
+
+    def name(self, category, bit):
+        """ Return name of the attribute in the category and bit. """
+        return self.attributes[category][bit.bit_length() - 1]
+
+    def solved(self):
+        """ Return True if every group has exactly one attribute of each type. """
+        return all(mask and not mask & (mask - 1) for mask in self.masks)
+
+    def positions(self, attribute):
+        """ Return bitmask of group indexes that can contain the attribute.
+
+        Unknown attributes can't be anywhere. A number is its own index.
+        """
+        if isinstance(attribute, int):
+            return 1 << attribute
         try:
-            other_attribute = flattened2[next_index]
-        except IndexError:
-            other_attribute = None
-        if other_attribute == attribute:
-            next_index += 1
-            continue
+            category, bit = self.ids[attribute]
+        except KeyError:
+            return 0
+        return self.places[category][bit.bit_length() - 1]
+
+    def discard(self, index, bits):
+        """ Remove bits from the mask in the index and record the event.
+
+        Raise UnsolvableException if no attributes are left in the mask.
+        """
+        bits &= self.masks[index]
+        if bits:
+            self.masks[index] ^= bits
+            self.events.append((index, bits))
+            self.trail.append((index, bits))
+            places = self.places[index % self.width]
+            group_bit = 1 << index // self.width
+            while bits:
+                bit = bits & -bits
+                places[bit.bit_length() - 1] ^= group_bit
+                bits ^= bit
+            if not self.masks[index]:
+                raise UnsolvableException("No attributes left in group {0}"
+                                          .format(index // self.width))
+
+    def remove(self, positions, attribute):
+        """ Remove the attribute from groups in the positions bitmask.
+
+        Raise UnsolvableException if a group runs out of attributes
+        of a type. Numbers and unknown attributes are ignored.
+        """
+        if isinstance(attribute, int) or attribute not in self.ids:
+            return
+        self.exclude(positions, *self.ids[attribute])
+
+    def exclude(self, positions, category, bit):
+        """ Remove the attribute in the category and bit from groups in
+        the positions bitmask.
+        """
+        index = category
+        while positions:
+            if positions & 1:
+                self.discard(index, bit)
+            positions >>= 1
+            index += self.width
+
+    def keep(self, index, attribute):
+        """ Remove other attributes of the same type from the group in the index.
+
+        If attribute does not exist in the index do nothing.
+
+        >>> groups = Groups.from_lists([[['cat', 'dog', 'mouse']], [['dog']]])
+        >>> groups.keep(0, 'cat')
+        >>> groups.to_lists()
+        [[['cat']], [['dog']]]
+        >>> groups.keep(0, 'platypus')
+        >>> groups.to_lists()
+        [[['cat']], [['dog']]]
+        """
+        if attribute not in self.ids:
+            return
+        category, bit = self.ids[attribute]
+        index = index * self.width + category
+        if self.masks[index] & bit:
+            self.discard(index, ~bit)
+
+
+def try_to_solve(constraints, groups, heuristic=None):
+    """ Try to recursively solve the puzzle.
+
+    Return the solved groups and True, or an empty list and False.
+    """
+    for result in search(constraints, groups, heuristic):
+        return result, True
+    return [], False
+
+
+def search(constraints, groups, heuristic=None, depth=None, stats=None, level=0,
+           budget=None, frontier=None, watches=None):
+    """ Yield groups every time they are solved.
+
+    If depth is given, also yield unsolved groups after that many
+    branches. Those are the roots of the subtrees left unexplored.
+
+    The heuristic picks the mask index to branch on and each attribute
+    still possible there is tried in turn. Groups are changed in place.
+    Every removal is recorded in groups.trail and a failed branch is
+    undone back to its mark instead of copying. The yielded groups are
+    the same object, so read them before resuming the generator.
+    Constraints must already be applied to the groups. The search is
+    traced in the optional stats, level is the number of branches taken
+    above these groups. The optional Budget is spent on every node.
+
+    The optional frontier list is kept as the decision stack, a
+    [mask index, bit, untried bits] entry for every branch taken above
+    the current node. If it holds more entries than the level when the
+    search starts, those branches are taken again first and only their
+    untried bits are searched after them: the search resumes where the
+    stack was saved. The budget isn't spent on the nodes taken again.
+    watches is the watch_list of the constraints, built once if not given.
+
+    >>> constraints = Constraints().order('red', 'blue').compile([['red', 'blue', 'green']])
+    >>> groups = apply_constraints(constraints, Groups([['red', 'blue', 'green']]))
+    >>> [solved.to_lists() for solved in search(constraints, groups)]
+    [[[['red']], [['blue']], [['green']]], [[['green']], [['red']], [['blue']]]]
+    >>> [solved.to_lists() for solved in search(constraints, groups, frontier=[[0, 4, 0]])]
+    [[[['green']], [['red']], [['blue']]]]
+    """
+    if budget is not None and (frontier is None or len(frontier) <= level):
+        # nodes above the saved position were paid for before
+        budget.spend()
+    if stats is not None:
+        stats.nodes += 1
+    if watches is None:
+        watches = watch_list(constraints)
+    try:
+        apply_constraints(constraints, groups, changed_only=True, stats=stats,
+                          watches=watches)
+    except UnsolvableException as error:
+        if stats is not None:
+            stats.fail(groups, level, error)
+        return
+
+    if groups.solved() or depth == 0:
+        yield groups
+        return
+    if depth is not None:
+        depth -= 1
+    if heuristic is None:
+        heuristic = fixed_order()
+    if frontier is not None and len(frontier) > level:
+        # resuming: the branch taken here is tried again before the rest
+        index, bit, mask = frontier[level]
+        mask |= bit
+    else:
+        index = heuristic(groups)
+        mask = groups.masks[index]
+        if frontier is not None:
+            frontier.append([index, 0, mask])
+    while mask:
+        bit = mask & -mask
+        mask ^= bit
+        if frontier is not None:
+            frontier[level][1:] = bit, mask
+        mark = groups.mark()
+        groups.discard(index, ~bit)
+        if stats is not None:
+            stats.branch(groups, index, bit, level + 1)
+        yield from search(constraints, groups, heuristic, depth, stats, level + 1, budget,
+                          frontier, watches)
+        groups.undo(mark)
+    if frontier is not None:
+        frontier.pop()
+
+
+def learning_search(constraints, groups, nogoods, heuristic=None, stats=None, path=(),
+                    budget=None, watches=None):
+    """ Yield groups every time they are solved, like search, learning
+    from failures.
+
+    path is the tuple of (mask index, bit) decisions taken above. When a
+    node fails, the decisions that cause the failure are found and
+    stored in nogoods, which then prune other subtrees where the same
+    attributes meet. When every branch of a node fails, the decisions
+    causing the failures together are the conflict of the node. If the
+    conflict doesn't include the decision of the parent, the parent's
+    other branches fail the same way and are skipped: the search jumps
+    back to the latest decision in the conflict.
+
+    The return value of the generator is the conflict as a set of
+    decisions, or None if solutions were found. The optional Budget is
+    spent on every node. watches is the watch_list of the constraints,
+    built once if not given.
+
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+    >>> constraints = Constraints().order('red', 'blue').compile(attributes)
+    >>> groups = apply_constraints(constraints, Groups(attributes))
+    >>> nogoods = Nogoods()
+    >>> nogoods.start(constraints, groups)
+    >>> len([solved for solved in learning_search(constraints, groups, nogoods)])
+    12
+    """
+    if budget is not None:
+        budget.spend()
+    if stats is not None:
+        stats.nodes += 1
+    if watches is None:
+        watches = watch_list(constraints)
+    try:
+        apply_constraints(constraints, groups, changed_only=True, stats=stats,
+                          watches=watches)
+        while nogoods.propagate(groups):
+            apply_constraints(constraints, groups, changed_only=True, stats=stats,
+                              watches=watches)
+    except UnsolvableException as error:
+        if stats is not None:
+            stats.fail(groups, len(path), error)
+        conflict = nogoods.explain(path)
+        nogoods.add(conflict)
+        return conflict
+
+    if groups.solved():
+        yield groups
+        return None
+    if heuristic is None:
+        heuristic = fixed_order()
+    index = heuristic(groups)
+    mask = groups.masks[index]
+    conflict = set()
+    found = False
+    while mask:
+        bit = mask & -mask
+        mask ^= bit
+        decision = (index, bit)
+        mark = groups.mark()
+        groups.discard(index, ~bit)
+        if stats is not None:
+            stats.branch(groups, index, bit, len(path) + 1)
+        child = yield from learning_search(constraints, groups, nogoods, heuristic, stats,
+                                           path + (decision,), budget, watches)
+        groups.undo(mark)
+        if child is None:
+            found = True
+        elif decision not in child:
+            nogoods.jumps += 1
+            return child
         else:
-            missing_attribute_indexes.append(i)
-            offset += 1
-    return missing_attribute_indexes
+            conflict.update(child)
+            conflict.discard(decision)
+    if found:
+        return None
+    conflict = nogoods.cover(conflict, path, index, groups.masks[index])
+    nogoods.add(conflict)
+    return conflict
 
 
-def remove_possibility(groups, offset=0):
-    """ Removes one attribute from attribute group where there are several. 
-    
-    Skip 'offset' number of possible removals.
-    Return True if successfully removed an attribute. If can't remove any
-    attributes (possibly because of offset), return False.
-    
-    >>> groups = [[['red', 'blue', 'green']], [['blue', 'green']]]
-    >>> remove_possibility(groups) #1
-    True
-    >>> groups #1
-    [[['blue', 'green']], [['blue', 'green']]]
-    >>> remove_possibility(groups) #2
-    True
-    >>> groups #2
-    [[['green']], [['blue', 'green']]]
-    >>> remove_possibility(groups) #3
-    True
-    >>> groups #3
-    [[['green']], [['green']]]
-    >>> remove_possibility(groups) #4
-    False
-    >>> groups #4
-    [[['green']], [['green']]]
-    
-    >>> groups2 = [[['cat', 'dog', 'bat', 'fish', 'mouse']]]
-    >>> remove_possibility(groups2, 4) #1
-    True
-    >>> groups2
-    [[['cat', 'dog', 'bat', 'fish']]]
-    >>> remove_possibility(groups2, 5) #2
-    False
-    >>> groups2 #2
-    [[['cat', 'dog', 'bat', 'fish']]]
-    
-    >>> groups3 = [[['cat', 'dog'], ['red', 'blue']], [['fish'], ['red', 'blue']]]
-    >>> remove_possibility(groups3, 4) #1
+class Nogoods:
+    """ Learned combinations of attributes that can't all hold.
+
+    A nogood is a frozenset of (mask index, bit) pairs: groups where all
+    of those masks are narrowed to the bit have no solution. At most
+    'limit' nogoods are kept, the oldest are dropped first. Nogoods are
+    checked against the root groups given to start(), so starting from
+    different groups or constraints forgets them.
+
+    jumps counts branches skipped by backjumping.
+
+    >>> attributes = [['red', 'blue'], ['cat', 'dog']]
+    >>> constraints = Constraints().compile(attributes)
+    >>> groups = apply_constraints(constraints, Groups(attributes))
+    >>> nogoods = Nogoods(limit=1)
+    >>> nogoods.start(constraints, groups)
+    >>> nogoods.add({(0, 0b01), (1, 0b01)})
+    >>> groups.keep(0, 'red')
+    >>> nogoods.propagate(groups)
     True
-    >>> groups3 #1
-    [[['cat', 'dog'], ['red', 'blue']], [['fish'], ['blue']]]
-    >>> remove_possibility(groups3, 3) #2
+    >>> groups.to_lists()
+    [[['red'], ['dog']], [['red', 'blue'], ['cat', 'dog']]]
+    """
+
+    def __init__(self, limit=1000):
+        self.limit = limit
+        # nogood -> None, oldest first
+        self.learned = OrderedDict()
+        self.jumps = 0
+        self.constraints = None
+        self.watches = None
+        self.root = None
+
+    def __len__(self):
+        return len(self.learned)
+
+    def start(self, constraints, groups, watches=None):
+        """ Use the groups, with the constraints applied, as the root.
+        watches is the watch_list of the constraints, built if not given.
+        """
+        if self.constraints is not constraints or self.root is None or \
+                self.root.masks != groups.masks:
+            self.learned.clear()
+        self.constraints = constraints
+        self.watches = watch_list(constraints) if watches is None else watches
+        self.root = groups.copy()
+        self.root.events = []
+
+    def add(self, nogood):
+        nogood = frozenset(nogood)
+        self.learned[nogood] = None
+        self.learned.move_to_end(nogood)
+        while len(self.learned) > self.limit:
+            self.learned.popitem(last=False)
+
+    def propagate(self, groups):
+        """ Remove attributes that would complete a nogood.
+
+        Return True if any attribute was removed, raise
+        UnsolvableException if a nogood holds.
+        """
+        masks = groups.masks
+        changed = False
+        for nogood in self.learned:
+            open_index = open_bit = None
+            for index, bit in nogood:
+                mask = masks[index]
+                if mask == bit:
+                    continue
+                if not mask & bit or open_index is not None:
+                    break
+                open_index, open_bit = index, bit
+            else:
+                if open_index is None:
+                    raise UnsolvableException('Learned nogood holds.')
+                groups.discard(open_index, open_bit)
+                changed = True
+        return changed
+
+    def narrow(self, decisions):
+        """ Return the root groups with the decisions and constraints
+        applied, or None if that fails.
+        """
+        groups = self.root.copy()
+        try:
+            for index, bit in decisions:
+                groups.discard(index, ~bit)
+            apply_constraints(self.constraints, groups, changed_only=True,
+                              watches=self.watches)
+            while self.propagate(groups):
+                apply_constraints(self.constraints, groups, changed_only=True,
+                                  watches=self.watches)
+        except UnsolvableException:
+            return None
+        return groups
+
+    def explain(self, path):
+        """ Return set of decisions of the path that fail together,
+        found by leaving out decisions one at a time, the latest first.
+        """
+        conflict = list(path)
+        for decision in reversed(path):
+            trial = [other for other in conflict if other != decision]
+            if self.narrow(trial) is None:
+                conflict = trial
+        return set(conflict)
+
+    def cover(self, conflict, path, index, tried):
+        """ Return the conflict with decisions of the path added, the
+        earliest first, until the mask in the index has no bits but the
+        tried ones.
+        """
+        conflict = set(conflict)
+        remaining = [decision for decision in path if decision not in conflict]
+        remaining.reverse()
+        while True:
+            groups = self.narrow(conflict)
+            if groups is None or not groups.masks[index] & ~tried:
+                return conflict
+            conflict.add(remaining.pop())
+
+
+def fixed_order():
+    """ Return heuristic that branches on the first unsolved mask.
+
+    >>> groups = Groups.from_lists([[['red'], ['cat', 'dog']], [['blue', 'red'], ['dog']]])
+    >>> fixed_order()(groups)
+    1
+    """
+    def choose(groups):
+        for index, mask in enumerate(groups.masks):
+            if mask & (mask - 1):
+                return index
+    return choose
+
+
+def fewest_remaining(constraints):
+    """ Return heuristic that branches on the mask with the fewest
+    attributes left. Ties go to the mask whose attributes are watched by
+    most constraints.
+
+    # same number of attributes left, but cat and dog are watched more
+    >>> attributes = [['red', 'blue'], ['cat', 'dog']]
+    >>> constraints = Constraints().together('red', 'cat').adjacent('dog', 'blue').order('cat', 'dog')
+    >>> choose = fewest_remaining(constraints.compile(attributes))
+    >>> groups = Groups(attributes)
+    >>> choose(groups)
+    1
+    >>> groups.keep(0, 'red')
+    >>> groups.remove(0b10, 'red')
+    >>> choose(groups)
+    1
+    >>> groups.keep(0, 'cat')
+    >>> choose(groups)
+    3
+    """
+    unwatched = [constraint for constraint in constraints
+                 if not hasattr(constraint, 'watches')]
+    # number of constraints reading each attribute, retired ones included
+    degrees = {}
+    for constraint in constraints:
+        for key in getattr(constraint, 'reads', getattr(constraint, 'watches', ())):
+            degrees[key] = degrees.get(key, len(unwatched)) + 1
+
+    def choose(groups):
+        width = groups.width
+        best = None
+        best_key = None
+        for index, mask in enumerate(groups.masks):
+            if not mask & (mask - 1):
+                continue
+            count = bit_count(mask)
+            if best_key is not None and count > best_key[0]:
+                continue
+            category = index % width
+            degree = 0
+            bits = mask
+            while bits:
+                bit = bits & -bits
+                degree += degrees.get((category, bit), len(unwatched))
+                bits ^= bit
+            key = (count, -degree)
+            if best_key is None or key < best_key:
+                best, best_key = index, key
+        return best
+    return choose
+
+
+def random_order(seed=None):
+    """ Return heuristic that branches on a random unsolved mask.
+
+    >>> groups = Groups.from_lists([[['red', 'blue']], [['red', 'blue']]])
+    >>> random_order(1)(groups) in (0, 1)
     True
-    >>> groups3 #2
-    [[['cat', 'dog'], ['red']], [['fish'], ['blue']]]
-    >>> remove_possibility(groups3, -1) #3
-    False
-    >>> groups3 #3
-    [[['cat', 'dog'], ['red']], [['fish'], ['blue']]]
     """
-    if offset < 0:
-        return False
-    skips_left = offset
-    for group in groups:
-        for attributes in group:
-            if len(attributes) > 1:
-                if skips_left < len(attributes):
-                    attributes.pop(skips_left)
-                    return True
-                else:
-                    skips_left -= len(attributes)
-    return False
+    generator = random.Random(seed)
+
+    def choose(groups):
+        return generator.choice([index for index, mask in enumerate(groups.masks)
+                                 if mask & (mask - 1)])
+    return choose
 
 
 def length_check(groups):
@@ -195,48 +1501,128 @@ def length_check(groups):
     return [len(atts) for group in groups for atts in group]
 
 
-def apply_constraints(constraints, groups):
-    """ Apply all constraints several times as long as groups change. """
-    last_iteration = ''
-    iteration_count = 0
-    while last_iteration != str(groups):
-        iteration_count += 1
-        last_iteration = str(groups)
+def apply_constraints(constraints, groups, changed_only=False, stats=None, watches=None):
+    """ Apply constraints until no attribute loses a group.
+
+    Constraints are kept in a worklist in the AC-3 style. Each constraint
+    lists the (category, bit) of the attributes it watches in its
+    'watches' attribute and is queued again only when one of them is
+    removed from a group. Functions without 'watches' are queued on every
+    change. Constraints with a true 'deferred' attribute are expensive and
+    only run when no other constraint is queued. The two global rules are
+    applied to the changed groups and attributes only.
+
+    If changed_only is set, start from the removals recorded in
+    groups.events instead of running every constraint. Constraint calls
+    are traced in the optional stats. watches is the watch_list of the
+    constraints; callers applying them at every node build it once and
+    pass it in.
+    """
+    if stats is not None:
+        stats.fixpoints += 1
+    if watches is None:
+        watches = watch_list(constraints)
+    watchers, unwatched = watches
+    queue = deque()
+    deferred = deque()
+    if not changed_only:
         for constraint in constraints:
-            constraint(groups)
+            (deferred if getattr(constraint, 'deferred', False) else queue).append(constraint)
         only_one_attribute_constraint(groups)
         solved_attribute_constraint(groups)
-    return groups
+    queued = set(queue)
+    queued.update(deferred)
+    events = groups.events
+    masks = groups.masks
+    width = groups.width
+    # the constraint called last and how many of the events are its own
+    # removals, at the bottom of the stack. An idempotent constraint
+    # isn't queued again by its own removals.
+    running = None
+    own = 0
+    while True:
+        while events:
+            mine = len(events) <= own
+            if mine:
+                own -= 1
+            index, bits = events.pop()
+            category = index % width
+            mask = masks[index]
+            if not mask & (mask - 1):
+                # the group is solved, no other group can have the attribute
+                groups.exclude(groups.full & ~(1 << index // width), category, mask)
+            places = groups.places[category]
+            while bits:
+                bit = bits & -bits
+                bits ^= bit
+                positions = places[bit.bit_length() - 1]
+                if not positions:
+                    raise UnsolvableException("No group left for '{0}'"
+                                              .format(groups.name(category, bit)))
+                if not positions & (positions - 1):
+                    groups.discard((positions.bit_length() - 1) * width + category, ~bit)
+                for constraint in watchers.get((category, bit), unwatched):
+                    if constraint not in queued and not (mine and constraint is running):
+                        queued.add(constraint)
+                        if getattr(constraint, 'deferred', False):
+                            deferred.append(constraint)
+                        else:
+                            queue.append(constraint)
+        if queue:
+            constraint = queue.popleft()
+        elif deferred:
+            constraint = deferred.popleft()
+        else:
+            return groups
+        queued.discard(constraint)
+        if stats is None:
+            constraint(groups)
+        else:
+            stats.propagate(constraint, groups)
+        if getattr(constraint, 'idempotent', False):
+            running = constraint
+            own = len(events)
 
 
-def flatten_groups(groups):
-    """ Return groups as flattened list.
-    
-    >>> flatten_groups([[['red', 'blue'], ['cat', 'dog']], [['cat']]])
-    ['red', 'blue', 'cat', 'dog', 'cat']
+def watch_list(constraints):
+    """ Return a mapping from attribute (category, bit) to constraints
+    watching it.
+
+    Also return the constraints that don't declare what they watch;
+    those are included for every attribute.
+
+    >>> constraints = Constraints().together('red', 'cat').middle('red')
+    >>> watchers, unwatched = watch_list(constraints.compile([['red', 'blue'], ['cat', 'dog']]))
+    >>> sorted((key, len(watching)) for key, watching in watchers.items())
+    [((0, 1), 1), ((1, 1), 1)]
     """
-    return [x for y in groups for z in y for x in z]
+    unwatched = [constraint for constraint in constraints
+                 if not hasattr(constraint, 'watches')]
+    watchers = {}
+    for constraint in constraints:
+        for key in getattr(constraint, 'watches', ()):
+            watchers.setdefault(key, list(unwatched)).append(constraint)
+    return watchers, unwatched
 
 
 def only_one_attribute_constraint(groups):
     """ Remove other attributes from group if an attribute is the only one. 
     
     If an attribute exists in exactly one group, remove other
-    attributes of that type from that group.
+    attributes of that type from that group. An attribute that exists
+    in no group makes the puzzle unsolvable.
     
     # there is only one 'red' so remove other colors from the same group
-    >>> groups = [[['red', 'blue', 'green']], [['blue', 'green']]]
-    >>> only_one_attribute_constraint(groups)
-    [[['red']], [['blue', 'green']]]
-    """
-    flattened = flatten_groups(groups)
-    counts = Counter(flattened)
-    for attribute, count in counts.items():
-        if count == 1:
-            indexes = attribute_indexes(groups, attribute)
-            for index in indexes:
-                remove_other_attributes(groups, index, attribute)
-
+    >>> groups = Groups.from_lists([[['red', 'blue', 'green']], [['blue', 'green']], [['blue', 'green']]])
+    >>> only_one_attribute_constraint(groups).to_lists()
+    [[['red']], [['blue', 'green']], [['blue', 'green']]]
+    """
+    for attribute in groups.ids:
+        positions = groups.positions(attribute)
+        if not positions:
+            raise UnsolvableException("No group left for '{0}'".format(attribute))
+        if not positions & (positions - 1):
+            groups.keep(positions.bit_length() - 1, attribute)
     return groups
 
 
@@ -247,246 +1633,899 @@ def solved_attribute_constraint(groups):
     remove the attribute from all the other groups.
     
     # 'blue' is alone in a group so remove it from everywhere else
-    >>> groups = [[['blue', 'green'], ['cat','dog']], [['red','blue']], [['blue']]]
-    >>> solved_attribute_constraint(groups)
-    [[['green'], ['cat', 'dog']], [['red']], [['blue']]]
+    >>> groups = Groups.from_lists([[['blue', 'green'], ['cat','dog']], [['red','blue']], [['blue']]])
+    >>> solved_attribute_constraint(groups).to_lists()
+    [[['green'], ['cat', 'dog']], [['red'], []], [['blue'], []]]
     
     # 'red' is a loner in 2 groups so task is unsolvable
-    >>> groups2 = [[['red']], [['red']], [['blue', 'red']]]
+    >>> groups2 = Groups.from_lists([[['red']], [['red']], [['blue', 'red']]])
     >>> solved_attribute_constraint(groups2) # doctest: +IGNORE_EXCEPTION_DETAIL
     Traceback (most recent call last):
     ...
     UnsolvableException
     
     # multiple singleton attributes
-    >>> groups3 = [[['green'], ['cat', 'dog']], [['blue', 'green'], ['cat']], [['yellow'], []]]
-    >>> solved_attribute_constraint(groups3)
+    >>> groups3 = Groups.from_lists([[['green'], ['cat', 'dog']], [['blue', 'green'], ['cat']], [['yellow'], []]])
+    >>> solved_attribute_constraint(groups3).to_lists()
     [[['green'], ['dog']], [['blue'], ['cat']], [['yellow'], []]]
     """
-    singleton_indexes = {}
-    for group in enumerate(groups):
-        for attributes in group[1]:
-            if len(attributes) == 1 and attributes[0] in singleton_indexes:
+    masks = groups.masks
+    width = groups.width
+    # (category, bit) -> bitmask of the group index where it is solved
+    singleton_positions = {}
+    for index, mask in enumerate(masks):
+        if mask and not mask & (mask - 1):
+            key = (index % width, mask)
+            if key in singleton_positions:
                 raise UnsolvableException("Multiple groups with only one possible attribute.")
-            elif len(attributes) == 1:
-                singleton_indexes[attributes[0]] = group[0]
-    for attribute, index in singleton_indexes.items():
-        indexes_to_remove = set(range(len(groups))).difference({index})
-        remove_attributes(groups, indexes_to_remove, [attribute])
+            singleton_positions[key] = 1 << (index // width)
+    for (category, bit), position in singleton_positions.items():
+        groups.exclude(groups.full & ~position, category, bit)
     return groups
 
 
-def remove_other_attributes(groups, index, attribute):
-    """ Remove other attributes from the group in the index.
-    
-    If attribute does not exist in the index do nothing.
-    
-    >>> groups = [[['cat', 'dog', 'mouse']], [['dog']]]
-    >>> remove_other_attributes(groups, 0, 'cat')
-    [[['cat']], [['dog']]]
-    >>> remove_other_attributes(groups, 0, 'platypus') # doctest: +IGNORE_EXCEPTION_DETAIL
-    [[['cat']], [['dog']]]
-    """
-    for attributes in groups[index]:
-        if attribute in attributes:
-            attributes.clear()
-            attributes.append(attribute)
-    return groups
+class Term:
+    """ Attribute of a constraint resolved against groups.
 
+    A name is resolved to its category and bit, a number is a fixed
+    group index. Raise AttributeNotFoundException if the name is not one
+    of the attributes or the number is not a group index.
+    """
+    __slots__ = ('attribute', 'category', 'bit', 'position', 'key', 'fixed')
 
-def attribute_indexes(groups, attribute):
-    """ Return indexes of groups that contain the attribute.
-    
-    If attribute is a number, return it inside a list instead
+    def __init__(self, groups, attribute):
+        self.attribute = attribute
+        if isinstance(attribute, int):
+            if not 0 <= attribute < len(groups):
+                raise AttributeNotFoundException(
+                    'Group index: %s not found in %s groups' % (attribute, len(groups)))
+            self.category = self.key = None
+            self.fixed = 1 << attribute
+            return
+        try:
+            self.category, self.bit = groups.ids[attribute]
+        except KeyError:
+            raise AttributeNotFoundException(
+                'Attribute: %s not found in attributes: %s' % (attribute, groups.attributes))
+        self.position = self.bit.bit_length() - 1
+        self.key = (self.category, self.bit)
+
+    def positions(self, groups):
+        """ Return bitmask of group indexes that can contain the attribute. """
+        if self.category is None:
+            return self.fixed
+        return groups.places[self.category][self.position]
+
+    def remove(self, groups, positions):
+        """ Remove the attribute from groups in the positions bitmask. """
+        if self.category is not None:
+            groups.exclude(positions, self.category, self.bit)
+
+
+class Propagator:
+    """ Compiled constraint.
+
+    Calling it with groups removes attributes that don't adhere to the
+    constraint and returns the groups. 'watches' lists the (category, bit)
+    of the attributes it reads. A call leaves nothing for a second call
+    to remove, so the constraint is idempotent, unless it reads the same
+    attribute twice.
+
+    >>> attributes = [['a0', 'a1', 'a2'], ['b0', 'b1', 'b2']]
+    >>> Solver(attributes, Constraints().left_of('a0', 'a0')).count_solutions()
+    0
     """
-    if(isinstance(attribute, int )):
-        return [attribute]
-    indexes = []
-    for group in enumerate(groups):
-        for attributes in group[1]:
-            if attribute in attributes:
-                indexes.append(group[0])
-    return indexes
 
+    idempotent = True
+
+    def __init__(self, *terms):
+        self.terms = terms
+        # attributes it reads
+        self.reads = tuple(term.key for term in terms if term.key is not None)
+        # a constraint on one attribute only compares it to fixed group
+        # indexes: once applied it can't remove anything again, so it
+        # isn't watched and is retired after the first full pass
+        self.watches = self.reads if len(self.reads) > 1 else ()
+        if len(set(self.reads)) < len(self.reads):
+            # both terms are the same attribute: removing positions from
+            # one changes the other, so a second call can remove more
+            self.idempotent = False
+
+
+class TogetherPropagator(Propagator):
+
+    def __call__(self, groups):
+        term1, term2 = self.terms
+        positions1 = term1.positions(groups)
+        positions2 = term2.positions(groups)
+        if not positions1 & positions2:
+            raise UnsolvableException("No attributes '{0}' and '{1}' found together"
+                                      .format(term1.attribute, term2.attribute))
+        wrong_positions = positions1 ^ positions2
+        term1.remove(groups, wrong_positions)
+        term2.remove(groups, wrong_positions)
+        return groups
+
+
+class AdjacentPropagator(Propagator):
+
+    def __call__(self, groups):
+        term1, term2 = self.terms
+        positions1 = term1.positions(groups)
+        positions2 = term2.positions(groups)
+        # attribute is legal if the other attribute is on either side
+        legal_positions1 = (positions2 << 1 | positions2 >> 1) & groups.full
+        legal_positions2 = (positions1 << 1 | positions1 >> 1) & groups.full
+        if not legal_positions1 & positions1:
+            raise UnsolvableException("No matching adjacent attributes found.")
+        term1.remove(groups, groups.full & ~legal_positions1)
+        term2.remove(groups, groups.full & ~legal_positions2)
+        return groups
+
+
+class OrderPropagator(Propagator):
+
+    def __call__(self, groups):
+        term1, term2 = self.terms
+        positions1 = term1.positions(groups)
+        positions2 = term2.positions(groups)
+        legal_positions1 = positions2 >> 1
+        legal_positions2 = (positions1 << 1) & groups.full
+        if not legal_positions1 & positions1:
+            raise UnsolvableException("No matching adjacent attributes found.")
+        term1.remove(groups, groups.full & ~legal_positions1)
+        term2.remove(groups, groups.full & ~legal_positions2)
+        return groups
+
+
+class RelationPropagator(Propagator):
+    """ Binary constraint given as a table.
+
+    table[index] is the bitmask of group indexes where the second
+    attribute can be if the first attribute is in the group index. The
+    table is built once per puzzle size, propagating is a lookup for
+    every group index left.
+
+    >>> groups = Groups([['red', 'blue', 'green'], ['cat', 'dog', 'fish']])
+    >>> table = relation_table(lambda index1, index2: index1 < index2, len(groups))
+    >>> [bin(mask) for mask in table]
+    ['0b110', '0b100', '0b0']
+    >>> RelationPropagator(Term(groups, 'red'), Term(groups, 'cat'), table)(groups).to_lists()
+    [[['red', 'blue', 'green'], ['dog', 'fish']], [['red', 'blue', 'green'], ['cat', 'dog', 'fish']], [['blue', 'green'], ['cat', 'dog', 'fish']]]
+    """
+
+    def __init__(self, term1, term2, table):
+        Propagator.__init__(self, term1, term2)
+        self.table = table
+        # the same relation seen from the second attribute
+        self.reverse = [sum(1 << index1 for index1, mask in enumerate(table) if mask >> index2 & 1)
+                        for index2 in range(len(table))]
+
+    def __call__(self, groups):
+        term1, term2 = self.terms
+        positions1 = term1.positions(groups)
+        positions2 = term2.positions(groups)
+        legal_positions1 = 0
+        for bit in iterate_bits(positions2):
+            legal_positions1 |= self.reverse[bit.bit_length() - 1]
+        legal_positions2 = 0
+        for bit in iterate_bits(positions1):
+            legal_positions2 |= self.table[bit.bit_length() - 1]
+        if not legal_positions1 & positions1:
+            raise UnsolvableException("No groups for '{0}' and '{1}' found."
+                                      .format(term1.attribute, term2.attribute))
+        term1.remove(groups, groups.full & ~legal_positions1)
+        term2.remove(groups, groups.full & ~legal_positions2)
+        return groups
+
+
+def relation_table(holds, count):
+    """ Return table for RelationPropagator: for every group index, the
+    bitmask of group indexes where holds(index1, index2) is true.
+    """
+    return [sum(1 << index2 for index2 in range(count) if holds(index1, index2))
+            for index1 in range(count)]
+
+
+class MiddlePropagator(Propagator):
+
+    def __init__(self, term, positions):
+        Propagator.__init__(self, term)
+        # bitmask of the middle group indexes
+        self.middle = positions
+
+    def __call__(self, groups):
+        term = self.terms[0]
+        if not term.positions(groups) & self.middle:
+            raise UnsolvableException("No attribute found in the middle.")
+        term.remove(groups, groups.full & ~self.middle)
+        return groups
+
+
+class CounterexamplePropagator(Propagator):
+    """ Fails groups that can't give another answer to a query, see
+    Solver.query.
+
+    'answers' maps each attribute still open to its (category, bit) and
+    the bit of its answer in the category. Groups where every one of
+    them is fixed to the group with its answer are failed. While it is
+    empty nothing is checked.
+
+    >>> groups = Groups([['red', 'blue'], ['cat', 'dog']])
+    >>> counter = CounterexamplePropagator(groups, 0, ['cat'])
+    >>> counter.answers['cat'] = (groups.ids['cat'], groups.ids['red'][1])
+    >>> counter(groups).to_lists()
+    [[['red', 'blue'], ['cat', 'dog']], [['red', 'blue'], ['cat', 'dog']]]
+    >>> groups.remove(0b10, 'cat')
+    >>> groups.keep(0, 'red')
+    >>> counter(groups) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    UnsolvableException
+    """
+
+    def __init__(self, groups, category, attributes):
+        Propagator.__init__(self)
+        self.category = category
+        self.watches = tuple(groups.ids[attribute] for attribute in attributes) + \
+            tuple((category, 1 << position)
+                  for position in range(len(groups.attributes[category])))
+        self.answers = {}
+
+    def __repr__(self):
+        return 'CounterexamplePropagator(category={0})'.format(self.category)
+
+    def __call__(self, groups):
+        if not self.answers:
+            return groups
+        width = groups.width
+        for (category, bit), answer in self.answers.values():
+            positions = groups.places[category][bit.bit_length() - 1]
+            if positions & (positions - 1):
+                return groups
+            if groups.masks[(positions.bit_length() - 1) * width + self.category] != answer:
+                return groups
+        raise UnsolvableException('No other answer in these groups')
+
+
+class AllDifferentPropagator(Propagator):
+    """ Every group has a different attribute of the category.
+
+    Finds a matching of groups to attributes and removes every
+    attribute that is in no perfect matching (Regin's algorithm), so
+    pairs and triples of groups sharing the same few attributes take
+    those attributes from the other groups. Solver adds one for every
+    category if all_different is set.
+
+    >>> groups = Groups.from_lists([[['red', 'blue']], [['red', 'blue']], [['red', 'blue', 'green']]])
+    >>> AllDifferentPropagator(groups, 0)(groups).to_lists()
+    [[['red', 'blue']], [['red', 'blue']], [['green']]]
+    >>> groups = Groups.from_lists([[['red', 'blue']], [['red', 'blue']], [['red', 'blue', 'green']]])
+    >>> groups.remove(0b100, 'green')
+    >>> AllDifferentPropagator(groups, 0)(groups) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    UnsolvableException
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+    >>> Solver(attributes, Constraints().order('red', 'blue'), all_different=True).count_solutions()
+    12
+    """
+
+    # matching every time is slower than the clues, run it last
+    deferred = True
+
+    def __init__(self, groups, category):
+        Propagator.__init__(self)
+        self.category = category
+        self.watches = tuple((category, 1 << position)
+                             for position in range(len(groups.attributes[category])))
+
+    def __repr__(self):
+        return 'AllDifferentPropagator(category={0})'.format(self.category)
+
+    def __call__(self, groups):
+        width = groups.width
+        indexes = range(self.category, len(groups.masks), width)
+        domains = [groups.masks[index] for index in indexes]
+        # attribute bit -> group that has it in the matching
+        owners = {}
+        for group in range(len(domains)):
+            if not self.augment(group, domains, owners, [0]):
+                raise UnsolvableException("No matching of groups to attributes.")
+        components = self.components(domains, owners)
+        for group, index in enumerate(indexes):
+            wrong = 0
+            bits = domains[group]
+            while bits:
+                bit = bits & -bits
+                bits ^= bit
+                if components[owners[bit]] != components[group]:
+                    wrong |= bit
+            groups.discard(index, wrong)
+        return groups
+
+    def augment(self, group, domains, owners, seen):
+        """ Find an augmenting path from the group (Kuhn's algorithm). """
+        bits = domains[group] & ~seen[0]
+        while bits:
+            bit = bits & -bits
+            bits ^= bit
+            seen[0] |= bit
+            if bit not in owners or self.augment(owners[bit], domains, owners, seen):
+                owners[bit] = group
+                return True
+        return False
+
+    def components(self, domains, owners):
+        """ Return strongly connected component of every group in the
+        graph with an edge to the owner of every attribute in its domain.
+        """
+        count = len(domains)
+        edges = [[owners[bit] for bit in iterate_bits(domain) if owners[bit] != group]
+                 for group, domain in enumerate(domains)]
+        order = []
+        low = [0] * count
+        number = [None] * count
+        component = [None] * count
+        stack = []
+
+        def visit(group):
+            # Tarjan's algorithm
+            number[group] = low[group] = len(order)
+            order.append(group)
+            stack.append(group)
+            for other in edges[group]:
+                if number[other] is None:
+                    visit(other)
+                    low[group] = min(low[group], low[other])
+                elif component[other] is None:
+                    low[group] = min(low[group], number[other])
+            if low[group] == number[group]:
+                while True:
+                    other = stack.pop()
+                    component[other] = group
+                    if other == group:
+                        break
+
+        for group in range(count):
+            if number[group] is None:
+                visit(group)
+        return component
+
+
+class Together(namedtuple('Together', 'attribute1 attribute2')):
+    """ Constraint: Attributes belong in the same group. """
+    __slots__ = ()
+    # swapping the attributes gives the same constraint
+    symmetric = True
+
+    def holds(self, index1, index2):
+        return index1 == index2
+
+    def compile(self, groups):
+        return TogetherPropagator(Term(groups, self.attribute1),
+                                  Term(groups, self.attribute2))
+
+
+class Adjacent(namedtuple('Adjacent', 'attribute1 attribute2')):
+    """ Constraint: Attributes are next to each other in any order. """
+    __slots__ = ()
+    # swapping the attributes gives the same constraint
+    symmetric = True
+
+    def holds(self, index1, index2):
+        return abs(index1 - index2) == 1
+
+    def compile(self, groups):
+        return AdjacentPropagator(Term(groups, self.attribute1),
+                                  Term(groups, self.attribute2))
 
-def remove_attributes(groups, indexes, attributes):
-    """ Remove all given attributes from the given indexes.
-    
-    >>> groups = [[['blue'], ['cat', 'dog']], [['red', 'blue'], ['cat', 'dog']]]
-    >>> remove_attributes(groups, [0, 1], ['cat'])
-    [[['blue'], ['dog']], [['red', 'blue'], ['dog']]]
-    >>> remove_attributes(groups, [1], ['red', 'dog'])
-    [[['blue'], ['dog']], [['blue'], []]]
-    """
-    for index in indexes:
-        for group in groups[index]:
-            for attribute in attributes:
-                if attribute in group:
-                    group.remove(attribute)
-    return groups
+
+class Order(namedtuple('Order', 'attribute1 attribute2')):
+    """ Constraint: First attribute is adjacent and left of the second. """
+    __slots__ = ()
+
+    def holds(self, index1, index2):
+        return index2 - index1 == 1
+
+    def compile(self, groups):
+        return OrderPropagator(Term(groups, self.attribute1),
+                               Term(groups, self.attribute2))
+
+
+class LeftOf(namedtuple('LeftOf', 'attribute1 attribute2')):
+    """ Constraint: First attribute is somewhere left of the second. """
+    __slots__ = ()
+
+    def holds(self, index1, index2):
+        return index1 < index2
+
+    def compile(self, groups):
+        return compile_relation(self, groups)
+
+
+class Apart(namedtuple('Apart', 'attribute1 attribute2 distance')):
+    """ Constraint: Attributes are exactly distance groups apart in
+    any order.
+    """
+    __slots__ = ()
+    symmetric = True
+
+    def holds(self, index1, index2):
+        return abs(index1 - index2) == self.distance
+
+    def compile(self, groups):
+        return compile_relation(self, groups)
+
+
+class NotAdjacent(namedtuple('NotAdjacent', 'attribute1 attribute2')):
+    """ Constraint: Attributes are not next to each other. """
+    __slots__ = ()
+    symmetric = True
+
+    def holds(self, index1, index2):
+        return abs(index1 - index2) != 1
+
+    def compile(self, groups):
+        return compile_relation(self, groups)
+
+
+class NotTogether(namedtuple('NotTogether', 'attribute1 attribute2')):
+    """ Constraint: Attributes are in different groups. """
+    __slots__ = ()
+    symmetric = True
+
+    def holds(self, index1, index2):
+        return index1 != index2
+
+    def compile(self, groups):
+        return compile_relation(self, groups)
+
+
+def compile_relation(record, groups):
+    """ Return RelationPropagator for a record of two attributes with a
+    holds(index1, index2) method.
+    """
+    return RelationPropagator(Term(groups, record.attribute1), Term(groups, record.attribute2),
+                              relation_table(record.holds, len(groups)))
+
+
+class Middle(namedtuple('Middle', 'attribute')):
+    """ Constraint: Attribute is in the middle group. If number of groups
+    is even both centermost groups are considered middle.
+    """
+    __slots__ = ()
+
+    def compile(self, groups):
+        middle = len(groups) // 2
+        positions = 1 << middle
+        if len(groups) % 2 == 0:
+            positions |= 1 << (middle - 1)
+        return MiddlePropagator(Term(groups, self.attribute), positions)
 
 
 class Constraints:
     """ Defines constraints for solver.
-    
-    Data attribute 'constraints' contains a list of functions that
-    can be used to test if a a list of groups fulfills the constraints.
-    Ordering of the group list matters: first item in the list is the 
-    leftmost group and last is the rightmost.
+
+    Data attribute 'clues' contains a list of constraint records such as
+    Together('red', 'cat'). Records are plain data, so constraints can be
+    pickled, compared and sent to worker processes. compile() turns the
+    records into propagators: functions that remove attributes that don't
+    adhere to the constraints from Groups. Each propagator has a 'watches'
+    attribute listing the attributes it reads, so it only needs to run
+    again when one of them changes.
+    Ordering of the groups matters: first group is the leftmost
+    group and last is the rightmost.
+
+    >>> import pickle
+    >>> constraints = Constraints().together('red', 'cat').middle('dog')
+    >>> constraints.clues
+    [Together(attribute1='red', attribute2='cat'), Middle(attribute='dog')]
+    >>> pickle.loads(pickle.dumps(constraints)).clues == constraints.clues
+    True
     """
 
     def __init__(self):
-        """ Initialize constraints with a number of groups."""
-        self.constraints = []
+        """ Initialize constraints with no clues."""
+        self.clues = []
+
+    def add(self, clue):
+        """ Add a constraint record. Anything with a compile(groups) method
+        returning a propagator can be used as a record.
+        """
+        self.clues.append(clue)
+        return self
+
+    def compile(self, attributes, count=None, all_different=False):
+        """ Return list of propagators for the attributes.
+
+        Attribute names are resolved once, unknown attributes raise
+        AttributeNotFoundException here instead of while solving. Count is
+        the number of groups, by default the length of the attribute lists.
+        If all_different is set, an AllDifferentPropagator is added after
+        the clues for every category with an attribute for each group.
+
+        >>> Constraints().together('old gold', 'snails').compile([['old gold', 'kool']]) # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        AttributeNotFoundException
+        """
+        groups = Groups(attributes, count)
+        propagators = []
+        for clue in self.clues:
+            propagator = clue.compile(groups)
+            # the record it came from, for reports
+            propagator.clue = clue
+            propagators.append(propagator)
+        if all_different:
+            propagators.extend(AllDifferentPropagator(groups, category)
+                               for category, names in enumerate(attributes)
+                               if len(names) == len(groups))
+        return propagators
 
     def together(self, attribute1, attribute2):
         """ Add constraint: Attributes belong in the same group.
-        >>> groups = [[['blue', 'green'],['cat','dog']],[['red','blue'],['cat','dog']]]
+        >>> groups = Groups.from_lists([[['blue', 'green'],['cat','dog']],[['red','blue'],['cat','dog']]])
         >>> constraints = Constraints()
         >>> constraints.together('red','cat') # doctest: +ELLIPSIS
         <...Constraints object at ...>
-        >>> constraints.constraints[0](groups)
-        [[['blue', 'green'], ['dog']], [['red', 'blue'], ['cat', 'dog']]]
+        >>> constraints.compile(groups.attributes, len(groups))[0](groups).to_lists()
+        [[['blue', 'green'], ['dog']], [['blue', 'red'], ['cat', 'dog']]]
         >>> constraints.together('green','dog') # doctest: +ELLIPSIS
         <...Constraints object at ...>
-        >>> constraints.constraints[1](groups)
-        [[['blue', 'green'], ['dog']], [['red', 'blue'], ['cat']]]
-        
+        >>> constraints.compile(groups.attributes, len(groups))[1](groups).to_lists()
+        [[['blue', 'green'], ['dog']], [['blue', 'red'], ['cat']]]
+
         >>> constraints2 = Constraints()
         >>> constraints2.together('old gold', 'snails') # doctest: +ELLIPSIS
         <...Constraints object at ...>
-        >>> groups2 = [[['platypus']], [['old gold']]]
-        >>> constraints2.constraints[0](groups2) # doctest: +IGNORE_EXCEPTION_DETAIL
+        >>> groups2 = Groups.from_lists([[['kool'], ['snails']], [['old gold'], ['dog']]])
+        >>> constraints2.compile(groups2.attributes, len(groups2))[0](groups2) # doctest: +IGNORE_EXCEPTION_DETAIL
         Traceback (most recent call last):
         ...
         UnsolvableException
         """
-        def together_test(groups):
-            """ Remove attributes that don't adhere to constraints from the groups. """
-            indexes1 = set(attribute_indexes(groups, attribute1))
-            indexes2 = set(attribute_indexes(groups, attribute2))
-            legal_indexes = indexes1.intersection(indexes2)
-            wrong_indexes = indexes1.symmetric_difference(indexes2)
-            if len(legal_indexes) == 0:
-                raise UnsolvableException("No attributes '{0}' and '{1}' found together"
-                                           .format(attribute1, attribute2))
-            remove_attributes(groups, wrong_indexes, [attribute1, attribute2])
-            return groups
-
-        self.constraints.append(together_test)
-        return self
+        return self.add(Together(attribute1, attribute2))
 
     def adjacent(self, attribute1, attribute2):
         """ Add constraint: Attributes are next to each other in any order.
 
-        >>> constraints = Constraints() 
+        >>> constraints = Constraints()
         >>> constraints.adjacent('red','cat') # doctest: +ELLIPSIS
         <...Constraints object at ...>
-        >>> groups = [[['blue'],['cat','dog']],[['red','blue'],['cat','dog']]]
-        >>> constraints.constraints[0](groups)
-        [[['blue'], ['cat', 'dog']], [['red', 'blue'], ['dog']]]
-        >>> groups2 = [[['red'],['cat','dog']],[['red','green'],['dog']]]
-        >>> constraints.constraints[0](groups2)
-        [[[], ['cat', 'dog']], [['red', 'green'], ['dog']]]
-        >>> groups3 = [[['red']],[['dog']]]
-        >>> constraints.constraints[0](groups3) # doctest: +IGNORE_EXCEPTION_DETAIL
+        >>> groups = Groups.from_lists([[['blue'],['cat','dog']],[['red','blue'],['cat','dog']]])
+        >>> constraints.compile(groups.attributes, len(groups))[0](groups).to_lists()
+        [[['blue'], ['cat', 'dog']], [['blue', 'red'], ['dog']]]
+        >>> groups2 = Groups.from_lists([[['red', 'green'],['cat','dog']],[['red','green'],['dog']]])
+        >>> constraints.compile(groups2.attributes, len(groups2))[0](groups2).to_lists()
+        [[['green'], ['cat', 'dog']], [['red', 'green'], ['dog']]]
+        >>> groups3 = Groups.from_lists([[['red'], ['dog']], [['blue'], ['fish']], [['green'], ['cat']]])
+        >>> constraints.compile(groups3.attributes, len(groups3))[0](groups3) # doctest: +IGNORE_EXCEPTION_DETAIL
         Traceback (most recent call last):
         ...
         UnsolvableException
-        >>> groups4 = [[['red']], [['llama']], [['red', 'green']], [['cat']]]
-        >>> constraints.constraints[0](groups4)
-        [[[]], [['llama']], [['red', 'green']], [['cat']]]
-        """
-
-        def adjacent_test(groups):
-            index1 = set(attribute_indexes(groups, attribute1))
-            index2 = set(attribute_indexes(groups, attribute2))
-            length = len(groups)
-            # attribute is legal if the other attribute is on either side
-            legal_indexes1 = {item for i in index2 for item in (i-1, i+1)
-                              if 0 <= item < length}
-            legal_indexes2 = {item for i in index1 for item in (i-1, i+1)
-                              if 0 <= item < length}
-            if len(legal_indexes1) == 0:
-                raise UnsolvableException("No matching adjacent attributes found.")
-            wrong_indexes1 = set(range(length)).difference(legal_indexes1)
-            wrong_indexes2 = set(range(length)).difference(legal_indexes2)
-            remove_attributes(groups, wrong_indexes1, [attribute1])
-            remove_attributes(groups, wrong_indexes2, [attribute2])
-            return groups
-
-        self.constraints.append(adjacent_test)
-        return self
+        >>> groups4 = Groups.from_lists([[['red', 'green']], [['llama']], [['red', 'green']], [['cat']]])
+        >>> constraints.compile(groups4.attributes, len(groups4))[0](groups4).to_lists()
+        [[['green']], [['llama']], [['red', 'green']], [['cat']]]
+        """
+        return self.add(Adjacent(attribute1, attribute2))
 
     def order(self, attribute1, attribute2):
         """ Add constraint: First attribute is adjacent and left of the second.
-        >>> constraints = Constraints() 
+        >>> constraints = Constraints()
         >>> constraints.order('red','cat') # doctest: +ELLIPSIS
         <...Constraints object at ...>
-        >>> groups = [[['red', 'blue'], ['cat','dog']], [['red', 'blue'], ['cat', 'dog']]]
-        >>> constraints.constraints[0](groups)
+        >>> groups = Groups.from_lists([[['red', 'blue'], ['cat','dog']], [['red', 'blue'], ['cat', 'dog']]])
+        >>> constraints.compile(groups.attributes, len(groups))[0](groups).to_lists()
         [[['red', 'blue'], ['dog']], [['blue'], ['cat', 'dog']]]
-        >>> groups2 = [[['red'],['cat','dog']],[['red','green'],['dog']]]
-        >>> constraints.constraints[0](groups2) # doctest: +IGNORE_EXCEPTION_DETAIL
+        >>> groups2 = Groups.from_lists([[['red'],['cat','dog']],[['red','green'],['dog']]])
+        >>> constraints.compile(groups2.attributes, len(groups2))[0](groups2) # doctest: +IGNORE_EXCEPTION_DETAIL
         Traceback (most recent call last):
         ...
         UnsolvableException
-        >>> groups3 = [[['red']],[['cat']]]
-        >>> constraints.constraints[0](groups3)
+        >>> groups3 = Groups.from_lists([[['red']],[['cat']]])
+        >>> constraints.compile(groups3.attributes, len(groups3))[0](groups3).to_lists()
         [[['red']], [['cat']]]
-        >>> groups4 = [[['red']], [['llama']], [['red', 'green']], [['cat']]]
-        >>> constraints.constraints[0](groups4)
-        [[[]], [['llama']], [['red', 'green']], [['cat']]]
-        """
-        def order_test(groups):
-            index1 = set(attribute_indexes(groups, attribute1))
-            index2 = set(attribute_indexes(groups, attribute2))
-            length = len(groups)
-            legal_indexes1 = {item - 1 for item in index2 if 0 <= item - 1 < length}
-            legal_indexes2 = {item + 1 for item in index1 if 0 <= item + 1 < length}
-            if len(legal_indexes1) == 0:
-                raise UnsolvableException("No matching adjacent attributes found.")
-            wrong_indexes1 = set(range(length)).difference(legal_indexes1)
-            wrong_indexes2 = set(range(length)).difference(legal_indexes2)
-            remove_attributes(groups, wrong_indexes1, [attribute1])
-            remove_attributes(groups, wrong_indexes2, [attribute2])
-            return groups
-
-        self.constraints.append(order_test)
-        return self
+        >>> groups4 = Groups.from_lists([[['red', 'green']], [['llama']], [['red', 'green']], [['cat']]])
+        >>> constraints.compile(groups4.attributes, len(groups4))[0](groups4).to_lists()
+        [[['green']], [['llama']], [['red', 'green']], [['cat']]]
+        """
+        return self.add(Order(attribute1, attribute2))
 
     def middle(self, attribute):
         """ Add constraint: Attribute is in the middle group. If number
         of groups is even both centermost groups are considered middle.
-        
-        >>> constraints = Constraints() 
+
+        >>> constraints = Constraints()
         >>> constraints.middle('red') # doctest: +ELLIPSIS
         <...Constraints object at ...>
-        >>> groups = [[['red', 'blue']], [['red', 'blue']], [['cat', 'dog']]]
-        >>> constraints.constraints[0](groups)
+        >>> groups = Groups.from_lists([[['red', 'blue']], [['red', 'blue']], [['cat', 'dog']]])
+        >>> constraints.compile(groups.attributes, len(groups))[0](groups).to_lists()
         [[['blue']], [['red', 'blue']], [['cat', 'dog']]]
-        >>> groups2 = [[['red']],[['cat']]]
-        >>> constraints.constraints[0](groups2)
+        >>> groups2 = Groups.from_lists([[['red']],[['cat']]])
+        >>> constraints.compile(groups2.attributes, len(groups2))[0](groups2).to_lists()
         [[['red']], [['cat']]]
-        >>> groups3 = [[['red']], [['black']], [['red']]]
-        >>> constraints.constraints[0](groups3) # doctest: +IGNORE_EXCEPTION_DETAIL
+        >>> groups3 = Groups.from_lists([[['red']], [['black']], [['red']]])
+        >>> constraints.compile(groups3.attributes, len(groups3))[0](groups3) # doctest: +IGNORE_EXCEPTION_DETAIL
         Traceback (most recent call last):
         ...
         UnsolvableException
         """
-        def middle_test(groups):
-            middle = len(groups) // 2
-            indexes = {middle}
-            if len(groups) % 2 == 0:
-                indexes.add(middle - 1)
-            wrong_indexes = set(range(len(groups))).difference(indexes)
-            if len(set(attribute_indexes(groups, attribute)).intersection(indexes)) < 1:
-                raise UnsolvableException("No attribute found in the middle.")
-            remove_attributes(groups, wrong_indexes, [attribute])
-            return groups
+        return self.add(Middle(attribute))
+
+    def left_of(self, attribute1, attribute2):
+        """ Add constraint: First attribute is somewhere left of the second.
+
+        >>> constraints = Constraints().left_of('red', 'cat')
+        >>> groups = Groups([['red', 'blue', 'green'], ['cat', 'dog', 'fish']])
+        >>> constraints.compile(groups.attributes)[0](groups).to_lists()
+        [[['red', 'blue', 'green'], ['dog', 'fish']], [['red', 'blue', 'green'], ['cat', 'dog', 'fish']], [['blue', 'green'], ['cat', 'dog', 'fish']]]
+        """
+        return self.add(LeftOf(attribute1, attribute2))
+
+    def apart(self, attribute1, attribute2, distance):
+        """ Add constraint: Attributes are exactly distance groups apart.
+
+        >>> constraints = Constraints().apart('red', 'cat', 2).together('cat', 2)
+        >>> Solver([['red', 'blue', 'green'], ['cat', 'dog', 'fish']], constraints).solve()[0][0]
+        [['red'], ['dog']]
+        """
+        return self.add(Apart(attribute1, attribute2, distance))
+
+    def not_adjacent(self, attribute1, attribute2):
+        """ Add constraint: Attributes are not next to each other.
+
+        >>> constraints = Constraints().not_adjacent('red', 'cat').together('cat', 1)
+        >>> Solver([['red', 'blue', 'green'], ['cat', 'dog', 'fish']], constraints).solve()[0][1]
+        [['red'], ['cat']]
+        >>> constraints.not_together('red', 'cat') # doctest: +ELLIPSIS
+        <...Constraints object at ...>
+        >>> Solver([['red', 'blue', 'green'], ['cat', 'dog', 'fish']], constraints).count_solutions()
+        0
+        """
+        return self.add(NotAdjacent(attribute1, attribute2))
+
+    def not_together(self, attribute1, attribute2):
+        """ Add constraint: Attributes are in different groups.
+
+        >>> constraints = Constraints().not_together('red', 'cat').together('cat', 0).together('blue', 1)
+        >>> Solver([['red', 'blue', 'green'], ['cat', 'dog', 'fish']], constraints).solve()[0][0]
+        [['green'], ['cat']]
+        """
+        return self.add(NotTogether(attribute1, attribute2))
+
+
+# constraint records by the name used in JSON puzzles
+RECORDS = {
+    'together': Together,
+    'adjacent': Adjacent,
+    'order': Order,
+    'middle': Middle,
+    'left_of': LeftOf,
+    'apart': Apart,
+    'not_adjacent': NotAdjacent,
+    'not_together': NotTogether,
+}
+
+
+def read_puzzle(puzzle):
+    """ Return attributes and Constraints of a puzzle decoded from JSON.
+
+    A puzzle is an object with the attribute lists and a list of
+    constraints, each a record name from RECORDS followed by its
+    arguments. An (attributes, Constraints) tuple is returned as is.
+
+    Attributes must be a non-empty list of lists of the same length,
+    holding strings no other list has. An argument of a constraint is
+    an attribute name or a group index, a distance is a number.
+    Anything else raises ValueError.
+
+    >>> attributes, constraints = read_puzzle({'attributes': [['red', 'blue']],
+    ...                                        'constraints': [['together', 'red', 1]]})
+    >>> constraints.clues
+    [Together(attribute1='red', attribute2=1)]
+    >>> read_puzzle([1, 2])
+    Traceback (most recent call last):
+    ...
+    ValueError: Puzzle is not an object: [1, 2]
+    >>> read_puzzle({'attributes': [['red', 'blue'], ['cat', 'red']]})
+    Traceback (most recent call last):
+    ...
+    ValueError: Attribute is in more than one list: 'red'
+    >>> read_puzzle({'attributes': [['red', 'blue']], 'constraints': [['together', 'red', True]]})
+    Traceback (most recent call last):
+    ...
+    ValueError: Argument is not an attribute or group index: True
+    """
+    if isinstance(puzzle, tuple):
+        return puzzle
+    if not isinstance(puzzle, dict):
+        raise ValueError('Puzzle is not an object: {0!r}'.format(puzzle))
+    attributes = read_attributes(puzzle.get('attributes'))
+    count = len(attributes[0])
+    clues = puzzle.get('constraints', [])
+    if not isinstance(clues, list):
+        raise ValueError('Constraints are not a list: {0!r}'.format(clues))
+    constraints = Constraints()
+    for clue in clues:
+        if not isinstance(clue, list) or not clue:
+            raise ValueError('Constraint is not a non-empty list: {0!r}'.format(clue))
+        name, *arguments = clue
+        record = RECORDS.get(name) if isinstance(name, str) else None
+        if record is None:
+            raise ValueError('Unknown constraint: {0!r}'.format(name))
+        if len(arguments) != len(record._fields):
+            raise ValueError('Constraint {0} takes {1} arguments: {2!r}'
+                             .format(name, len(record._fields), clue))
+        for field, argument in zip(record._fields, arguments):
+            if field == 'distance':
+                if not is_number(argument) or argument < 0:
+                    raise ValueError('Distance is not a non-negative number: {0!r}'
+                                     .format(argument))
+            elif is_number(argument):
+                if not 0 <= argument < count:
+                    raise ValueError('Group index out of range: {0}'.format(argument))
+            elif not isinstance(argument, str):
+                raise ValueError('Argument is not an attribute or group index: {0!r}'
+                                 .format(argument))
+        constraints.add(record(*arguments))
+    return attributes, constraints
+
+
+def read_attributes(attributes):
+    """ Return the attribute lists of a JSON puzzle after checking them,
+    see read_puzzle.
+
+    >>> read_attributes('ab')
+    Traceback (most recent call last):
+    ...
+    ValueError: Attributes are not a non-empty list of lists: 'ab'
+    """
+    if not isinstance(attributes, list) or not attributes or \
+            not all(isinstance(names, list) and names for names in attributes):
+        raise ValueError('Attributes are not a non-empty list of lists: {0!r}'
+                         .format(attributes))
+    if len({len(names) for names in attributes}) != 1:
+        raise ValueError('Attribute lists differ in length: {0!r}'.format(attributes))
+    seen = set()
+    for names in attributes:
+        for name in names:
+            if not isinstance(name, str):
+                raise ValueError('Attribute is not a string: {0!r}'.format(name))
+            if name in seen:
+                raise ValueError('Attribute is in more than one list: {0!r}'.format(name))
+            seen.add(name)
+    return attributes
+
+
+def is_number(value):
+    """ Return True if the value is an int but not a bool. """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def solve_puzzle(index, puzzle, timeout=None, profile=None, slow=1.0):
+    """ Return the result of a puzzle as a dict for JSON.
+
+    'solved' is True, False or None if the timeout ran out and 'answer'
+    is what Solver.solve returned. A string is decoded as a JSON line. A
+    puzzle that can't be read or names an unknown attribute gets an
+    'error' instead. Other exceptions are raised. If profile is a
+    directory and solving took at least slow seconds, cProfile data is
+    written there as <index>.prof.
+
+    >>> solve_puzzle(0, {'attributes': [['red', 'blue']], 'constraints': [['together', 'red', 1]]})['answer']
+    [[['blue']], [['red']]]
+    >>> solve_puzzle(1, {'attributes': [['red', 'blue']], 'constraints': [['middle', 'cat']]})['error']
+    "Attribute: cat not found in attributes: [['red', 'blue']]"
+    >>> solve_puzzle(2, '{"attributes": []}')['error']
+    'Attributes are not a non-empty list of lists: []'
+    """
+    result = {'index': index}
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    try:
+        if isinstance(puzzle, str):
+            puzzle = json.loads(puzzle)
+        if isinstance(puzzle, dict) and 'id' in puzzle:
+            result['id'] = puzzle['id']
+        attributes, constraints = read_puzzle(puzzle)
+        if profiler is not None:
+            profiler.enable()
+        try:
+            answer, solved = Solver(attributes, constraints).solve(timeout=timeout)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    except (AttributeNotFoundException, ValueError) as error:
+        result['error'] = str(error)
+        return result
+    result['seconds'] = time.perf_counter() - start
+    result['solved'] = solved
+    result['answer'] = answer
+    if profiler is not None and result['seconds'] >= slow:
+        profiler.dump_stats(os.path.join(profile, '{0}.prof'.format(index)))
+    return result
+
+
+def solve_chunk(chunk, timeout=None, profile=None, slow=1.0):
+    """ Return results of (index, puzzle) pairs. Used by worker processes. """
+    return [solve_puzzle(index, puzzle, timeout, profile, slow) for index, puzzle in chunk]
+
+
+def solve_many(puzzles, workers=None, chunk_size=16, timeout=None, profile=None, slow=1.0):
+    """ Yield results of puzzles in input order, see solve_puzzle.
+
+    Puzzles are JSON objects, JSON lines or (attributes, Constraints)
+    tuples read lazily from any iterable. With workers they are solved in chunks of
+    chunk_size in a pool of that many processes. At most two chunks per
+    worker are read ahead, so memory use doesn't grow with the input.
+    Blank lines are skipped but counted, so the 'index' of a result is
+    the position of its puzzle in the input, for lines the line number
+    counting from 0.
+
+    >>> puzzles = [{'attributes': [['red', 'blue']], 'constraints': [['together', 'red', 1]]},
+    ...            ([['red', 'blue']], Constraints().order('red', 'blue'))]
+    >>> [result['answer'] for result in solve_many(puzzles, chunk_size=1)]
+    [[[['blue']], [['red']]], [[['red']], [['blue']]]]
+    >>> lines = ['{"attributes": [["red", "blue"]]}', '', 'not json'] * 3
+    >>> [(result['index'], 'error' in result) for result in solve_many(lines, workers=2, chunk_size=2)]
+    [(0, False), (2, True), (3, False), (5, True), (6, False), (8, True)]
+    """
+    puzzles = ((index, puzzle) for index, puzzle in enumerate(puzzles)
+               if not isinstance(puzzle, str) or puzzle.strip())
+    chunks = iter(lambda: list(itertools.islice(puzzles, chunk_size)), [])
+    if not workers:
+        for chunk in chunks:
+            yield from solve_chunk(chunk, timeout, profile, slow)
+        return
+    executor = ProcessPoolExecutor(workers)
+    pending = deque()
+    finished = False
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(solve_chunk, chunk, timeout, profile, slow))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+        finished = True
+    finally:
+        # only a generator closed early leaves chunks to cancel
+        executor.shutdown(wait=finished, cancel_futures=not finished)
+
+
+def main(arguments=None):
+    """ Solve puzzles read as JSON lines and write results as JSON lines. """
+    parser = argparse.ArgumentParser(prog='python -m solving',
+                                     description='Solve puzzles, one JSON object per line.')
+    parser.add_argument('input', nargs='?', help='file of puzzles, standard input by default')
+    parser.add_argument('--output', help='file for results, standard output by default')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=16,
+                        help='puzzles sent to a worker at a time')
+    parser.add_argument('--timeout', type=float, help='seconds of search for each puzzle')
+    parser.add_argument('--profile', metavar='DIRECTORY',
+                        help='write cProfile data of slow puzzles to the directory')
+    parser.add_argument('--slow', type=float, default=1.0,
+                        help='seconds after which a puzzle is profiled')
+    options = parser.parse_args(arguments)
+    if options.profile:
+        os.makedirs(options.profile, exist_ok=True)
+    source = open(options.input) if options.input else sys.stdin
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        # lines are decoded by solve_puzzle, so a bad line only fails itself
+        for result in solve_many(source, options.workers, options.chunk_size,
+                                 options.timeout, options.profile, options.slow):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    return 0
 
-        self.constraints.append(middle_test)
-        return self
 
 if __name__ == '__main__':
-    doctest.testmod()
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import itertools
+import doctest
+
+import numpy as np
+
+from solving import AttributeNotFoundException, Constraints, Middle
+
+
+class Solver:
+    """ Solves the same puzzles as solving.Solver by filtering
+    permutations with numpy arrays.
+
+    Every category is a permutation of group indexes. All N!
+    permutations are built once as an integer array where
+    permutations[p, position] is the group index of the attribute in
+    the position. Each category's permutations are filtered in bulk
+    against constraints that only concern that category, like middle
+    and together with a group index. Categories are then joined one by
+    one: rows of already joined permutations are paired with the next
+    category's permutations and masks of the constraints between them
+    keep the pairs that fit.
+
+    Meant for batch checks on small puzzles, memory grows with the
+    number of partial solutions.
+
+    >>> attributes = [['red', 'blue', 'green'], ['cat', 'dog', 'fish']]
+    >>> constraints = Constraints().order('blue', 'green').together('dog', 'green') \\
+    ...     .together('cat', 0).adjacent('red', 'fish')
+    >>> Solver(attributes, constraints).solve()
+    ([[['red'], ['cat']], [['blue'], ['fish']], [['green'], ['dog']]], True)
+    >>> Solver(attributes, Constraints().middle('red')).count_solutions()
+    12
+    """
+
+    def __init__(self, attributes, constraints, chunk_size=1 << 22):
+        self.attributes = attributes
+        self.count = len(attributes[0])
+        # largest mask built at once while joining
+        self.chunk_size = chunk_size
+        # attribute name -> (category, position)
+        self.ids = {name: (category, position)
+                    for category, names in enumerate(attributes)
+                    for position, name in enumerate(names)}
+        self.permutations = np.array(list(itertools.permutations(range(self.count))),
+                                     dtype=np.int8)
+        # bool mask of permutations left for each category
+        self.candidates = [np.ones(len(self.permutations), dtype=bool)
+                           for _ in attributes]
+        # (category1, position1, category2, position2, relation)
+        self.links = []
+        for clue in constraints.clues:
+            self.add(clue)
+        self.rows = None
+
+    def resolve(self, attribute):
+        """ Return (category, position) of an attribute, or (None, index)
+        for a group index.
+        """
+        if isinstance(attribute, int):
+            if not 0 <= attribute < self.count:
+                raise AttributeNotFoundException(
+                    'Group index: %s not found in %s groups' % (attribute, self.count))
+            return None, attribute
+        try:
+            return self.ids[attribute]
+        except KeyError:
+            raise AttributeNotFoundException(
+                'Attribute: %s not found in attributes: %s' % (attribute, self.attributes))
+
+    def indexes(self, term):
+        """ Return group indexes of the term for every permutation. """
+        category, position = term
+        if category is None:
+            return position
+        return self.permutations[:, position]
+
+    def add(self, clue):
+        """ Filter permutations with a constraint on one category or
+        record a link between two categories.
+        """
+        if isinstance(clue, Middle):
+            category, position = term = self.resolve(clue.attribute)
+            middle = [self.count // 2]
+            if self.count % 2 == 0:
+                middle.append(self.count // 2 - 1)
+            mask = np.isin(self.indexes(term), middle)
+            self.filter(category, mask)
+            return
+        # relation of the group indexes of the two attributes, works on
+        # arrays as well
+        relation = getattr(clue, 'holds', None)
+        if relation is None:
+            raise TypeError('Constraint %r is not supported' % (clue,))
+        term1 = self.resolve(clue.attribute1)
+        term2 = self.resolve(clue.attribute2)
+        categories = {term1[0], term2[0]} - {None}
+        if len(categories) == 2:
+            self.links.append(term1 + term2 + (relation,))
+        else:
+            mask = relation(self.indexes(term1), self.indexes(term2))
+            self.filter(categories.pop() if categories else None, mask)
+
+    def filter(self, category, mask):
+        """ Keep permutations of the category where the mask is set. A
+        constraint without attributes removes everything if it fails.
+        """
+        if category is None:
+            if not np.all(mask):
+                for candidates in self.candidates:
+                    candidates[:] = False
+            return
+        self.candidates[category] &= mask
+
+    def join(self):
+        """ Return array of solutions, one row of permutation indexes per
+        solution with a column for each category.
+        """
+        if self.rows is not None:
+            return self.rows
+        candidates = [np.nonzero(mask)[0] for mask in self.candidates]
+        order = []
+        rows = np.zeros((1, 0), dtype=np.int64)
+        remaining = set(range(len(self.attributes)))
+        while remaining:
+            # join the category most linked to the joined ones, then the smallest
+            category = max(remaining, key=lambda index: (
+                sum(1 for link in self.links
+                    if index in (link[0], link[2]) and
+                    (link[0] in order or link[2] in order)),
+                -len(candidates[index])))
+            rows = self.join_category(rows, order, category, candidates[category])
+            order.append(category)
+            remaining.remove(category)
+        # columns back to the category order
+        self.rows = rows[:, np.argsort(order)]
+        return self.rows
+
+    def join_category(self, rows, order, category, candidates):
+        """ Return rows extended with every fitting permutation of the category. """
+        permutations = self.permutations
+        links = []
+        for category1, position1, category2, position2, relation in self.links:
+            if category1 == category and category2 in order:
+                links.append((order.index(category2), position2, position1, relation, True))
+            elif category2 == category and category1 in order:
+                links.append((order.index(category1), position1, position2, relation, False))
+        step = max(1, self.chunk_size // max(1, len(candidates)))
+        pieces = []
+        for start in range(0, len(rows), step):
+            block = rows[start:start + step]
+            mask = np.ones((len(block), len(candidates)), dtype=bool)
+            for column, joined_position, position, relation, new_first in links:
+                joined = permutations[block[:, column], joined_position][:, None]
+                new = permutations[candidates, position][None, :]
+                mask &= relation(new, joined) if new_first else relation(joined, new)
+            block_rows, candidate_indexes = np.nonzero(mask)
+            pieces.append(np.column_stack((block[block_rows], candidates[candidate_indexes])))
+        if not pieces:
+            return np.zeros((0, len(order) + 1), dtype=np.int64)
+        return np.concatenate(pieces)
+
+    def to_lists(self, row):
+        """ Return a solution row in the nested list format of solving.Solver. """
+        answer = [[None] * len(self.attributes) for _ in range(self.count)]
+        for category, names in enumerate(self.attributes):
+            for position, index in enumerate(self.permutations[row[category]]):
+                answer[index][category] = [names[position]]
+        return answer
+
+    def solve(self):
+        """ Return the first solution as nested lists and a success flag. """
+        rows = self.join()
+        if not len(rows):
+            return [], False
+        return self.to_lists(rows[0]), True
+
+    def iter_solutions(self):
+        """ Yield every solution as nested lists. """
+        for row in self.join():
+            yield self.to_lists(row)
+
+    def count_solutions(self, limit=None):
+        """ Return number of solutions, at most limit. """
+        count = len(self.join())
+        return count if limit is None else min(count, limit)
+
+
+if __name__ == '__main__':
+    doctest.testmod()